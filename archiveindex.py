@@ -0,0 +1,106 @@
+# Keeps an index of the CSV files written for each uPMU, so that the rows for
+# a range of time can be found without walking the directory structure.
+#
+# The directory of a serial number holds two append-only files. windows.idx
+# has a fixed-size entry for each CSV file written, with the start and end of
+# its window (in seconds since the epoch), its path relative to the directory,
+# and the location in seconds.idx of the byte offsets of the first row of each
+# second of the window in the (uncompressed) file, followed by the offset of
+# the end of the window's rows. Seconds with no record have an offset of -1.
+# A window written again (by backfill.py --overwrite) is indexed again, and
+# its last entry is used. The receiver processes and backfill.py may index
+# the same serial number at the same time, so an entry is added by one writer
+# at a time, under a lock on windows.idx.
+import fcntl
+import gzip
+import numpy as np
+import os
+
+WINDOWS = 'windows.idx'
+SECONDS = 'seconds.idx'
+ENTRY = np.dtype([('start', '<i8'), ('end', '<i8'), ('offsets', '<i8'), ('path', 'S232')])
+
+class IndexException(RuntimeError):
+    pass
+
+def open_csv(filename):
+    """ Opens the CSV file FILENAME, which is gzip-compressed if it ends with
+    .gz, for reading. """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def csv_offsets(contents, num_seconds):
+    """ Returns the offsets in CONTENTS, a CSV file for a window of
+    NUM_SECONDS seconds, of the first row of each second and of the end of
+    the window's rows, as an array of NUM_SECONDS + 1 integers. """
+    newlines = np.flatnonzero(np.frombuffer(contents, dtype=np.uint8) == ord('\n'))
+    if len(newlines) <= 120 * num_seconds:
+        raise IndexException('the CSV file has fewer than {0} rows'.format(120 * num_seconds))
+    offsets = newlines[:120 * num_seconds + 1:120] + 1
+    offsets[:-1][newlines[1:120 * num_seconds + 1:120] - newlines[:120 * num_seconds:120] <= 2] = -1 # An empty row is only '\r\n'
+    return offsets
+
+def index_window(serialdir, filename, cycle_start, num_seconds, contents=None):
+    """ Adds the CSV file FILENAME, in SERIALDIR, for the window of
+    NUM_SECONDS seconds starting at CYCLE_START to the index of SERIALDIR.
+    CONTENTS are the uncompressed contents of the file, which is read if
+    they are not given. """
+    path = filename[len(serialdir):]
+    if not filename.startswith(serialdir) or len(path) > ENTRY['path'].itemsize:
+        raise IndexException('cannot index {0} in {1}'.format(filename, serialdir))
+    if contents is None:
+        with open_csv(filename) as f:
+            contents = f.read()
+    offsets = csv_offsets(contents, num_seconds).astype('<i8')
+    with open(serialdir + WINDOWS, 'ab') as windows:
+        fcntl.flock(windows.fileno(), fcntl.LOCK_EX) # Released when closed
+        with open(serialdir + SECONDS, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            f.write(offsets.tostring())
+        entry = np.array([(cycle_start, cycle_start + num_seconds, position, path)], dtype=ENTRY)
+        windows.write(entry.tostring())
+
+def read_windows(serialdir):
+    """ Returns the entries of the index of SERIALDIR, as an array of ENTRY
+    sorted by start, with only the last entry for each window. """
+    try:
+        with open(serialdir + WINDOWS, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return np.zeros(0, dtype=ENTRY)
+    entries = np.frombuffer(data[:len(data) - len(data) % ENTRY.itemsize], dtype=ENTRY)
+    last = len(entries) - 1 - np.unique(entries['start'][::-1], return_index=True)[1]
+    return entries[last]
+
+def extract(serialdir, start, end, out):
+    """ Writes to OUT the rows of the CSV files in the index of SERIALDIR for
+    the seconds from START up to (not including) END, in seconds since the
+    epoch, in order. Only the rows of the window of each file are included,
+    not its duplicate and misplaced records. Returns the number of rows
+    written. """
+    entries = read_windows(serialdir)
+    entries = entries[(entries['start'] < end) & (entries['end'] > start)]
+    if not len(entries):
+        return 0
+    written = 0
+    with open(serialdir + SECONDS, 'rb') as seconds:
+        for entry in entries:
+            num_seconds = int(entry['end'] - entry['start'])
+            seconds.seek(int(entry['offsets']))
+            offsets = np.fromfile(seconds, dtype='<i8', count=num_seconds + 1)
+            first = max(start - int(entry['start']), 0)
+            last = min(end - int(entry['start']), num_seconds)
+            present = np.flatnonzero(offsets[first:last] >= 0)
+            if not len(present):
+                continue
+            after = np.flatnonzero(offsets[last:] >= 0) # The end of the window's rows is always there
+            begin = int(offsets[first + present[0]])
+            with open_csv(serialdir + entry['path']) as f:
+                f.seek(begin)
+                chunk = f.read(int(offsets[last + after[0]]) - begin)
+            rows = [row for row in chunk.split('\r\n') if row]
+            out.write('\r\n'.join(rows) + '\r\n')
+            written += len(rows)
+    return written
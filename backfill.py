@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+# Regenerates the output files of the windows whose received files were never
+# published (after a crash, a failed write, or a gap at a window boundary)
+# from the files stored in Mongo, cutting windows as receivercsv.py does, and
+# marks those files published. Serial numbers are spread over a pool of
+# processes, each of which streams the files of one serial number at a time.
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import pymongo
+import sys
+import traceback
+
+from columnar import EXTENSION as COLUMNAR_EXTENSION
+from parser import parse_records, times_to_epoch
+from rawstore import RawStore
+from rollups import encode_rollups
+from utils import epoch_to_datetime, find_irregularities, window_filename, window_start
+from windowbuffer import WindowBuffer
+from workers import encode_window, gzip_member, write_indexed
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--seconds', help='the number of seconds per output csv file', type=int, default=900)
+parser.add_argument('-d', '--depth', help='the depth of the files in the directory structure being sent (top level is at depth 0)', type=int, default=4)
+parser.add_argument('-o', '--output', help='the directory in which to store the csv files', default='output/')
+parser.add_argument('-f', '--format', help='the format of the output files: csv, compressed columnar files, or both', choices=('csv', 'columnar', 'both'), default='csv')
+parser.add_argument('-z', '--gzip', help='the gzip compression level (1-9) of the csv files, which are then named .csv.gz (0 to write them uncompressed)', type=int, choices=range(10), default=0)
+parser.add_argument('-r', '--rawstore', help='the directory in which the receiver stores the raw files, if it was run with --rawstore')
+parser.add_argument('-n', '--processes', help='the number of serial numbers to process at the same time (0 to process them one by one in this process)', type=int, default=multiprocessing.cpu_count())
+parser.add_argument('-b', '--batchsize', help='the number of files to fetch from Mongo at a time, and of files to mark published in one update', type=int, default=50)
+parser.add_argument('-u', '--serial', help='a serial number to process (may be given more than once; by default, every serial number with unpublished files)', action='append')
+parser.add_argument('-a', '--all', help='also write the last window of each serial number, which a running receiver may still be filling', action='store_true')
+parser.add_argument('--rollups', help='whether to compute per-second and per-minute statistics of each window and write them next to its output files (files), upsert the per-minute ones into the rollups collection (mongo), or both, as receivercsv.py does', choices=('none', 'files', 'mongo', 'both'), default='none')
+parser.add_argument('--overwrite', help='replace output files that already exist instead of leaving their windows unpublished', action='store_true')
+args = parser.parse_args()
+
+NUM_SECONDS_PER_FILE = args.seconds
+DIRDEPTH = args.depth
+OUTPUTDIR = args.output
+if args.output[-1] != '/':
+    OUTPUTDIR += '/'
+OUTPUTFORMAT = args.format
+GZIPLEVEL = args.gzip
+CSV_EXTENSION = '.csv.gz' if GZIPLEVEL > 0 else '.csv'
+NUM_PROCESSES = args.processes
+BATCHSIZE = args.batchsize
+WRITE_LAST = args.all
+OVERWRITE = args.overwrite
+ROLLUPS = args.rollups
+if ROLLUPS in ('mongo', 'both') and NUM_SECONDS_PER_FILE % 60 != 0:
+    parser.error('--rollups mongo requires --seconds to be a multiple of 60, so that no minute is split between windows')
+
+if args.rawstore is None:
+    rawstore = None
+else:
+    rawstore = RawStore(args.rawstore)
+
+currtime = datetime.datetime.utcnow()
+
+BASETIME = datetime.datetime(currtime.year, currtime.month, currtime.day, currtime.hour) # Windows are counted from it, as in receivercsv.py
+
+EXTENSIONS = {'csv': (CSV_EXTENSION,), 'columnar': (COLUMNAR_EXTENSION,), 'both': (CSV_EXTENSION, COLUMNAR_EXTENSION)}[OUTPUTFORMAT]
+
+aliases = {}
+
+try:
+    with open('serial_aliases.ini', 'r') as f:
+        for line in f:
+            pair = line.rstrip().split('=')
+            aliases[pair[0]] = pair[1]
+except:
+    print 'WARNING: Could not read serial_aliases.ini'
+
+received_files = None # The collections, opened separately in each process
+rollups = None
+
+def connect():
+    global received_files, rollups
+    database = pymongo.MongoClient().upmu_database
+    received_files = database.received_files
+    rollups = database.rollups
+
+class SerialBackfill(object):
+    """ Rebuilds the windows of SERIAL from its unpublished files. The files
+    are taken in the order in which they were received, and a window is
+    written once a file reaches past its end, as TCPResolver._writecsv
+    does, so records received late end up in the same place. """
+    def __init__(self, serial):
+        self.serial = serial
+        self.window = WindowBuffer(NUM_SECONDS_PER_FILE)
+        self.firstfilepath = None
+        self.published = [] # The ids of files whose windows have been written but that are not yet marked
+        self.files = 0
+        self.windows = 0
+        self.marked = 0
+
+    def run(self):
+        cursor = received_files.find({'serial_number': self.serial, 'published': False}, sort=[('_id', pymongo.ASCENDING)], batch_size=BATCHSIZE, no_cursor_timeout=True)
+        try:
+            for document in cursor:
+                self.add(document)
+        finally:
+            cursor.close()
+        if WRITE_LAST:
+            while len(self.window):
+                self.write(self.firstfilepath)
+        self.mark()
+        return self.files, self.windows, self.marked
+
+    def add(self, document):
+        try:
+            if 'sha256' in document:
+                data = rawstore.read(document['sha256'])
+            else:
+                data = document['data']
+            records = parse_records(data)
+        except BaseException as be:
+            print 'WARNING: could not read file {0} of serial number {1}: {2}'.format(document['name'], self.serial, be)
+            return
+        if not len(records):
+            return
+        self.files += 1
+        if self.firstfilepath is None:
+            self.firstfilepath = document['name']
+        epochs = times_to_epoch(records['sync_data']['times'])
+        if self.window.start is None:
+            self.window.move(window_start(int(epochs[0]), NUM_SECONDS_PER_FILE, BASETIME))
+        self.window.add(records, document['_id'])
+        latest_time = int(epochs.max())
+        while latest_time - self.window.start >= NUM_SECONDS_PER_FILE:
+            self.write(document['name'])
+
+    def write(self, nextfilepath):
+        """ Writes the current window, as TCPResolver._writecsv does, and
+        moves on to the next. NEXTFILEPATH is the path of the file whose data
+        triggered the write. """
+        cycle_start = self.window.start
+        cycle_end = cycle_start + NUM_SECONDS_PER_FILE
+        records, epochs, mongoids = self.window.take()
+        if not len(records):
+            return
+        filepath = self.firstfilepath
+        self.firstfilepath = nextfilepath
+        dirtowrite = '{0}{1}/'.format(OUTPUTDIR, aliases.get(self.serial, self.serial))
+        filename = window_filename(dirtowrite, filepath, DIRDEPTH, self.serial, epoch_to_datetime(cycle_start), epoch_to_datetime(cycle_end))
+        if not OVERWRITE and any(os.path.exists(filename + extension) for extension in EXTENSIONS):
+            print 'WARNING: {0} already exists; leaving its files unpublished'.format(filename)
+            return
+        try:
+            num_warnings = len(find_irregularities(epochs, cycle_start, cycle_end))
+            files = encode_window(records.tostring(), cycle_start, NUM_SECONDS_PER_FILE, OUTPUTFORMAT)
+            if GZIPLEVEL > 0:
+                files = [(CSV_EXTENSION, gzip_member(contents, GZIPLEVEL)) if extension == '.csv' else (extension, contents) for extension, contents in files]
+            if ROLLUPS != 'none':
+                rollupfiles, minutes = encode_rollups(records.tostring(), cycle_start, NUM_SECONDS_PER_FILE)
+                if ROLLUPS in ('files', 'both'):
+                    files.extend(rollupfiles)
+                if ROLLUPS in ('mongo', 'both'):
+                    for minute in minutes:
+                        minute['time'] = epoch_to_datetime(minute['time'])
+                        rollups.update_one({'serial_number': self.serial, 'time': minute['time']}, {'$set': minute}, upsert=True)
+            for written in write_indexed(filename, files, (), dirtowrite, cycle_start, NUM_SECONDS_PER_FILE):
+                print 'Successfully wrote file {0} ({1} warning(s))'.format(written, num_warnings)
+        except BaseException as be:
+            print 'ERROR: could not write window {0}: {1}'.format(filename, be)
+            return
+        self.windows += 1
+        self.published.extend(mongoids)
+        if len(self.published) >= BATCHSIZE:
+            self.mark()
+
+    def mark(self):
+        for i in xrange(0, len(self.published), BATCHSIZE):
+            ids = self.published[i:i + BATCHSIZE]
+            received_files.update_many({'_id': {'$in': ids}}, {'$set': {'published': True}})
+            self.marked += len(ids)
+        self.published = []
+
+def backfill(serial):
+    """ Rebuilds the windows of SERIAL. Returns SERIAL, the numbers of files
+    read, windows written and files marked published, and the traceback of
+    the exception that stopped it, if any. """
+    task = SerialBackfill(serial)
+    try:
+        task.run()
+        error = None
+    except BaseException:
+        error = traceback.format_exc()
+    sys.stdout.flush()
+    return serial, task.files, task.windows, task.marked, error
+
+if __name__ == '__main__':
+    client = pymongo.MongoClient()
+    client.upmu_database.received_files.create_index([('serial_number', pymongo.ASCENDING), ('published', pymongo.ASCENDING)])
+    if ROLLUPS in ('mongo', 'both'):
+        client.upmu_database.rollups.create_index([('serial_number', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+    serials = args.serial or client.upmu_database.received_files.distinct('serial_number', {'published': False})
+    client.close() # Each process opens its own connection
+    print 'Rebuilding the unpublished windows of {0} serial number(s)'.format(len(serials))
+    if NUM_PROCESSES > 0:
+        pool = multiprocessing.Pool(NUM_PROCESSES, connect)
+        results = pool.imap_unordered(backfill, serials)
+    else:
+        connect()
+        results = (backfill(serial) for serial in serials)
+    failed = 0
+    for serial, files, windows, marked, error in results:
+        print 'Serial number {0}: read {1} file(s), wrote {2} window(s), marked {3} file(s) published'.format(serial, files, windows, marked)
+        if error is not None:
+            print 'ERROR: could not finish serial number', serial
+            print 'Details:', error
+            failed += 1
+    if NUM_PROCESSES > 0:
+        pool.close()
+        pool.join()
+    if failed:
+        sys.exit(1)
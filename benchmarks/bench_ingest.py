@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+# Times the stages that a file goes through in receivercsv.py, on files
+# generated as upmu-sim does: parsing, converting a window to rows, encoding
+# its CSV file, checking a window for gaps and duplicates, writing a window
+# out, compressing its CSV file, and receiving messages through
+# TCPResolver.dataReceived in chunks of realistic sizes.
+# Results are printed in files per second and MB per second, and can be
+# saved as JSON and compared with an earlier run.
+
+import argparse
+import datetime
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fakemongo
+import receivercsv
+import upmusim
+
+from parser import decode_sync_outputs, parse, stack_records, sync_output
+from twisted.test import proto_helpers
+from utils import lst_to_rows, window_to_rows
+from windowbuffer import WindowBuffer
+from workers import encode_window, gzip_member
+
+START_TIME = 1420070400 # 2015-01-01 00:00:00 UTC, the start of a window
+SERIAL = 'P3001000'
+CHUNK_SIZES = (1460, 16384, 65536) # one TCP segment, and typical socket reads
+
+class Quiet(object):
+    """ Discards what the receiver prints while a benchmark runs. """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def best_time(func, repeat):
+    with Quiet():
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def result(seconds, files, length):
+    return {'seconds': seconds, 'files': files, 'bytes': length,
+            'files_per_sec': files / seconds, 'mb_per_sec': length / seconds / 1e6}
+
+def make_resolver(serial=SERIAL):
+    resolver = receivercsv.ResolverFactory().buildProtocol(None)
+    with Quiet():
+        resolver.makeConnection(proto_helpers.StringTransport())
+    resolver.serialNum = serial
+    return resolver
+
+def configure(outputdir, seconds=None):
+    arguments = ['-o', outputdir, '-p', '0']
+    if seconds is not None:
+        arguments += ['-s', str(seconds)]
+    receivercsv.configure(arguments)
+    receivercsv.prepare(fakemongo.Connection())
+
+def run(args):
+    random = np.random.RandomState(args.seed)
+    filesperwindow = -(-args.seconds // upmusim.SECONDS_PER_FILE) # The last one may be only partly in the window
+    windowfiles = args.seconds / float(upmusim.SECONDS_PER_FILE)
+    files = [upmusim.generate_file(START_TIME + upmusim.SECONDS_PER_FILE * i, random) for i in xrange(max(filesperwindow, args.files))]
+    window = ''.join(files[:filesperwindow])[:args.seconds * sync_output.DTYPE.itemsize]
+    results = {}
+    outputdir = tempfile.mkdtemp(prefix='bench_ingest')
+    try:
+        configure(outputdir, args.seconds)
+        cycleTime = datetime.datetime.utcfromtimestamp(START_TIME)
+        nextCycleTime = cycleTime + datetime.timedelta(0, args.seconds)
+
+        results['parse'] = result(best_time(lambda: parse(files[0]), args.repeat), 1, len(files[0]))
+
+        parsed = parse(window)
+        results['lst_to_rows'] = result(best_time(lambda: lst_to_rows(parsed), args.repeat), windowfiles, len(window))
+
+        results['window_to_rows'] = result(best_time(lambda: window_to_rows(stack_records(parsed), START_TIME, args.seconds), args.repeat), windowfiles, len(window))
+
+        resolver = make_resolver()
+
+        epochs = np.array([s.epoch for s in parsed], dtype=np.int64)
+        results['_check_duplicates'] = result(best_time(lambda: resolver._check_duplicates(epochs, cycleTime, nextCycleTime), args.repeat), windowfiles, len(window))
+
+        records = decode_sync_outputs(window)
+        results['encode_window'] = result(best_time(lambda: encode_window(records.tostring(), START_TIME, args.seconds, 'csv'), args.repeat), windowfiles, len(window))
+
+        def writecsv():
+            resolver.window = WindowBuffer(args.seconds, START_TIME)
+            resolver.window.add(records)
+            resolver.window.firstfilepath = upmusim.file_path(0)
+            resolver._writecsv(upmusim.file_path(filesperwindow))
+        results['_writecsv'] = result(best_time(writecsv, args.repeat), windowfiles, len(window))
+
+        csvdata = encode_window(records.tostring(), START_TIME, args.seconds, 'csv')[0][1]
+        for level in args.gzip or [1, 6]:
+            results['gzip_{0}'.format(level)] = result(best_time(lambda: gzip_member(csvdata, level), args.repeat), windowfiles, len(csvdata))
+            results['gzip_{0}'.format(level)]['ratio'] = len(csvdata) / float(len(gzip_member(csvdata, level)))
+
+        configure(outputdir) # Without CSV files, so that only receiving is timed
+        stream = ''.join(upmusim.frame_message(i, upmusim.file_path(i), SERIAL, f) for i, f in enumerate(files[:args.files]))
+        length = sum(len(f) for f in files[:args.files])
+        for chunksize in CHUNK_SIZES:
+            def receive():
+                resolver = make_resolver()
+                for offset in xrange(0, len(stream), chunksize):
+                    resolver.dataReceived(stream[offset:offset + chunksize])
+            results['dataReceived_{0}'.format(chunksize)] = result(best_time(receive, args.repeat), args.files, length)
+    finally:
+        shutil.rmtree(outputdir, True)
+    return results
+
+def report(results, baseline=None):
+    print '{0:<24} {1:>12} {2:>12} {3:>10}'.format('benchmark', 'files/s', 'MB/s', 'vs. base' if baseline else '')
+    for name in sorted(results):
+        r = results[name]
+        line = '{0:<24} {1:>12.1f} {2:>12.1f}'.format(name, r['files_per_sec'], r['mb_per_sec'])
+        if 'ratio' in r:
+            line += ' (compressed {0:.1f}:1)'.format(r['ratio'])
+        if baseline and name in baseline:
+            line += ' {0:>9.2f}x'.format(r['files_per_sec'] / baseline[name]['files_per_sec'])
+        print line
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-s', '--seconds', help='the number of seconds per output csv file', type=int, default=900)
+    argparser.add_argument('-f', '--files', help='the number of files to send through dataReceived', type=int, default=16)
+    argparser.add_argument('-r', '--repeat', help='the number of times to repeat each measurement', type=int, default=5)
+    argparser.add_argument('-z', '--gzip', help='a gzip level at which to time compressing the csv file of a window (may be given more than once)', type=int, action='append')
+    argparser.add_argument('--seed', help='the seed for the random phases of the generated files', type=int, default=0)
+    argparser.add_argument('-o', '--output', help='a file in which to save the results as JSON')
+    argparser.add_argument('-c', '--compare', help='a file of results saved by an earlier run to compare against')
+    args = argparser.parse_args()
+    if args.seconds < upmusim.SECONDS_PER_FILE:
+        argparser.error('--seconds must be at least {0}, the length of a file'.format(upmusim.SECONDS_PER_FILE))
+
+    results = run(args)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'time': datetime.datetime.utcnow().isoformat(), 'python': platform.python_version(),
+                       'machine': platform.node(), 'options': vars(args), 'results': results}, f, indent=2, sort_keys=True)
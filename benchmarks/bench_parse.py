@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+# Times parser.parse on files of increasing size to show that parse time
+# grows linearly with the number of records. The old parse loop, which
+# sliced off the rest of the buffer after every field, is timed alongside
+# it for comparison.
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parser import parse, parse_sync_output_msgq, parse_sync_pll_stats_msgq, parse_sync_gps_stats
+
+def make_file(num_records):
+    """ Returns a string containing NUM_RECORDS sync_outputs with consecutive
+    timestamps. """
+    records = []
+    for i in xrange(num_records):
+        minute, second = divmod(i, 60)
+        hour, minute = divmod(minute, 60)
+        header = struct.pack('<f6i', 1000.0 / 120, 2015, 1, 1 + hour / 24, hour % 24, minute, second)
+        lockstate = struct.pack('<120i', *(1 for _ in xrange(120)))
+        points = struct.pack('<1440f', *(float(j % 360) for j in xrange(1440)))
+        stats = struct.pack('<IIii7f', 0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 7.0, 0.0, 1.0)
+        records.append(header + lockstate + points + stats)
+    return ''.join(records)
+
+def legacy_parse(string):
+    """ The parse loop used before records were decoded in place. """
+    lst = []
+    while string:
+        f1, string = parse_sync_output_msgq(string)
+        f2, string = parse_sync_pll_stats_msgq(string)
+        f3, string = parse_sync_gps_stats(string)
+        lst.append((f1, f2, f3))
+    return lst
+
+def best_time(func, arg, repeat):
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=repeat))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-f', '--files', help='the largest input to time, in 120-record files', type=int, default=16)
+    argparser.add_argument('-r', '--repeat', help='the number of times to repeat each measurement', type=int, default=5)
+    argparser.add_argument('-l', '--legacy', help='also time the old slicing parse loop', action='store_true')
+    args = argparser.parse_args()
+
+    print '{0:>6} {1:>12} {2:>12} {3:>14}'.format('files', 'bytes', 'parse (s)', 'us per record'),
+    print '{0:>12} {1:>14}'.format('legacy (s)', 'us per record') if args.legacy else ''
+    numfiles = 1
+    while numfiles <= args.files:
+        string = make_file(120 * numfiles)
+        elapsed = best_time(parse, string, args.repeat)
+        print '{0:>6} {1:>12} {2:>12.4f} {3:>14.2f}'.format(numfiles, len(string), elapsed, 1e6 * elapsed / (120 * numfiles)),
+        if args.legacy:
+            elapsed = best_time(legacy_parse, string, 1)
+            print '{0:>12.4f} {1:>14.2f}'.format(elapsed, 1e6 * elapsed / (120 * numfiles))
+        else:
+            print
+        numfiles *= 2
@@ -0,0 +1,55 @@
+# A stand-in for a txmongo connection that answers every write, at once or
+# after a fixed delay, without storing anything, so that the receiver can be
+# benchmarked without a database.
+
+from twisted.internet import defer, reactor
+from txmongo._pymongo.objectid import ObjectId
+
+class Collection(object):
+    """ A collection whose writes complete after LATENCY seconds. """
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.latency = latency
+        self.inserts = 0
+        self.updates = 0
+
+    def _reply(self, result):
+        if self.latency <= 0:
+            return defer.succeed(result)
+        d = defer.Deferred()
+        reactor.callLater(self.latency, d.callback, result)
+        return d
+
+    def insert(self, docs, safe=False):
+        if isinstance(docs, list):
+            self.inserts += len(docs)
+            return self._reply([ObjectId() for doc in docs])
+        self.inserts += 1
+        return self._reply(ObjectId())
+
+    def update(self, spec, document, upsert=False, multi=False, safe=False):
+        self.updates += 1
+        return self._reply(None)
+
+    def create_index(self, sort_fields, **kwargs):
+        return self._reply(None)
+
+class Database(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.collections.setdefault(name, Collection(name, self.latency))
+
+class Connection(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.databases = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.databases.setdefault(name, Database(self.latency))
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+
+# Runs receivercsv.py's protocol against fakemongo and drives it with
+# simulated uPMUs over loopback, to find how many uPMUs, and how many files
+# per second, the receiver can take on this machine. The uPMUs run in a
+# separate process and speak the same protocol as sender.c: each sends a
+# file, waits for its 4-byte acknowledgement, and resends it after
+# reconnecting if the connection is lost first. Reports the latency of the
+# acknowledgements, how late the receiver's reactor runs its timers, and the
+# receiver's peak memory use.
+
+import argparse
+import json
+import numpy as np
+import os
+import resource
+import shlex
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fakemongo
+import upmusim
+
+from twisted.internet import defer, reactor, task, utils
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+
+START_TIME = 1420070400 # 2015-01-01 00:00:00 UTC
+LAG_INTERVAL = 0.05 # seconds between measurements of reactor lag
+RECONNECT_DELAY = 1.0 # seconds to wait before reconnecting, like TIMEDELAY in sender.c (which waits 10)
+
+def summarize(values):
+    """ Returns the count, percentiles, maximum and mean of VALUES. """
+    summary = {'count': len(values)}
+    if values:
+        for p in (50, 90, 99):
+            summary['p{0}'.format(p)] = float(np.percentile(values, p))
+        summary['max'] = float(max(values))
+        summary['mean'] = float(np.mean(values))
+    return summary
+
+class UPMUProtocol(Protocol):
+    def __init__(self, upmu):
+        self.upmu = upmu
+        self.response = ''
+
+    def connectionMade(self):
+        self.upmu.connected(self)
+
+    def dataReceived(self, data):
+        self.response += data
+        while len(self.response) >= 4:
+            ack, = struct.unpack('<I', self.response[:4])
+            self.response = self.response[4:]
+            self.upmu.acked(self, ack)
+
+    def connectionLost(self, reason):
+        self.upmu.disconnected(self)
+
+class SimulatedUPMU(object):
+    """ A uPMU that sends RATE files per second to the receiver at HOST and
+    PORT. After each acknowledged file it disconnects with probability
+    RECONNECT; each file has a gap of missing seconds with probability GAPS
+    and a duplicated second with probability DUPLICATES. """
+    def __init__(self, index, host, port, options, stats):
+        self.serial = 'P{0:07d}'.format(index)
+        self.host = host
+        self.port = port
+        self.options = options
+        self.stats = stats
+        self.random = np.random.RandomState(options.seed + index)
+        self.sendid = 0
+        self.filetime = START_TIME
+        self.message = None # The message being sent, until it is acknowledged
+        self.sent = None # When it was sent
+        self.protocol = None
+        self.stopping = False
+        self.finished = defer.Deferred()
+
+    def start(self):
+        reactor.callLater(self.random.uniform(0, 1.0 / self.options.rate), self.connect) # Jitter, as in upmusim.go
+
+    def stop(self):
+        self.stopping = True
+        if self.message is None:
+            self._finish()
+
+    def connect(self):
+        d = connectProtocol(TCP4ClientEndpoint(reactor, self.host, self.port), UPMUProtocol(self))
+        d.addErrback(self._connectfailed)
+
+    def _connectfailed(self, err):
+        self.stats['connect_failures'] += 1
+        if not self.stopping:
+            reactor.callLater(RECONNECT_DELAY, self.connect)
+        else:
+            self._finish()
+
+    def connected(self, protocol):
+        self.protocol = protocol
+        self.stats['connections'] += 1
+        if self.message is not None:
+            self.stats['resent'] += 1
+            self._send() # Resend the file that was not acknowledged
+        elif not self.stopping:
+            self.send_next()
+
+    def disconnected(self, protocol):
+        self.protocol = None
+        if self.message is not None or not self.stopping:
+            reactor.callLater(RECONNECT_DELAY, self.connect)
+
+    def _file(self):
+        records = upmusim.generate_records(self.filetime, upmusim.SECONDS_PER_FILE, self.random)
+        if self.random.random_sample() < self.options.gaps:
+            start = self.random.randint(0, len(records) - 1)
+            records = np.concatenate((records[:start], records[start + self.random.randint(1, 11):]))
+            self.stats['gaps'] += 1
+        if self.random.random_sample() < self.options.duplicates:
+            i = self.random.randint(0, len(records))
+            records = np.concatenate((records[:i + 1], records[i:]))
+            self.stats['duplicates'] += 1
+        self.filetime += upmusim.SECONDS_PER_FILE
+        return records.tostring()
+
+    def send_next(self):
+        if self.stopping:
+            self._finish()
+            return
+        if self.protocol is None:
+            return # Sent once reconnected
+        self.message = upmusim.frame_message(self.sendid, upmusim.file_path(self.sendid), self.serial, self._file())
+        self._send()
+
+    def _send(self):
+        self.sent = time.time()
+        self.protocol.transport.write(self.message)
+
+    def acked(self, protocol, ack):
+        if self.message is None:
+            return
+        self.stats['latencies'].append(time.time() - self.sent)
+        if ack != self.sendid:
+            self.stats['bad_acks'] += 1
+        self.stats['files'] += 1
+        self.stats['bytes'] += len(self.message)
+        self.message = None
+        self.sendid += 1
+        if self.stopping:
+            self._finish()
+        elif self.random.random_sample() < self.options.reconnect:
+            self.stats['reconnects'] += 1
+            protocol.transport.loseConnection()
+        else:
+            reactor.callLater(1.0 / self.options.rate, self.send_next)
+
+    def _finish(self):
+        if not self.finished.called:
+            if self.protocol is not None:
+                self.protocol.transport.loseConnection()
+            self.finished.callback(None)
+
+def drive(options):
+    """ Runs the simulated uPMUs for the duration of the test, then prints
+    their statistics as JSON. """
+    stats = {'files': 0, 'bytes': 0, 'latencies': [], 'bad_acks': 0, 'connections': 0, 'connect_failures': 0,
+             'reconnects': 0, 'resent': 0, 'gaps': 0, 'duplicates': 0}
+    upmus = [SimulatedUPMU(i, '127.0.0.1', options.port, options, stats) for i in xrange(options.upmus)]
+    for upmu in upmus:
+        upmu.start()
+    def stop():
+        for upmu in upmus:
+            upmu.stop()
+        d = defer.DeferredList([upmu.finished for upmu in upmus])
+        timeout = reactor.callLater(options.drain, d.cancel)
+        d.addBoth(lambda ignored: timeout.active() and timeout.cancel())
+        d.addBoth(lambda ignored: reactor.stop())
+    reactor.callLater(options.duration, stop)
+    started = time.time()
+    reactor.run()
+    stats['elapsed'] = time.time() - started
+    stats['unacknowledged'] = sum(1 for upmu in upmus if upmu.message is not None)
+    json.dump(stats, sys.stdout)
+
+class ReactorLag(object):
+    """ Measures how late the reactor runs a timer scheduled every
+    LAG_INTERVAL seconds. """
+    def __init__(self):
+        self.lags = []
+        self.last = None
+        self.loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        self.last = time.time()
+        self.loop.start(LAG_INTERVAL, now=False)
+
+    def _tick(self):
+        now = time.time()
+        self.lags.append(max(now - self.last - LAG_INTERVAL, 0))
+        self.last = now
+
+class Quiet(object):
+    """ Discards what the receiver prints while the test runs. """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def run(options):
+    """ Runs the receiver and the simulated uPMUs, and returns the results. """
+    import receivercsv
+    outputdir = tempfile.mkdtemp(prefix='loadtest')
+    try:
+        receivercsv.configure(['-o', outputdir, '-p', '0'] + shlex.split(options.receiverargs))
+        mconn = fakemongo.Connection(options.mongolatency)
+        receivercsv.prepare(mconn)
+        port = reactor.listenTCP(0, receivercsv.ResolverFactory(), interface='127.0.0.1')
+        arguments = [os.path.abspath(__file__), '--drive', '--port', str(port.getHost().port)] + sys.argv[1:]
+        lag = ReactorLag()
+        results = {}
+        def finished((output, errors, code)):
+            if code == 0:
+                results.update(json.loads(output))
+            else:
+                print >> sys.stderr, 'The simulated uPMUs failed:'
+                print >> sys.stderr, errors
+            reactor.stop()
+        def start():
+            lag.start()
+            d = utils.getProcessOutputAndValue(sys.executable, arguments, env=os.environ)
+            d.addCallback(finished)
+        reactor.callWhenRunning(start)
+        with Quiet():
+            reactor.run()
+    finally:
+        if not options.keep:
+            shutil.rmtree(outputdir, True)
+    if not results:
+        return None
+    latencies = results.pop('latencies')
+    results['ack_latency'] = summarize(latencies)
+    results['reactor_lag'] = summarize(lag.lags)
+    results['files_per_sec'] = results['files'] / results['elapsed']
+    results['mb_per_sec'] = results['bytes'] / results['elapsed'] / 1e6
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # ru_maxrss is in kilobytes on Linux
+    results['mongo_writes'] = dict((name, {'inserts': c.inserts, 'updates': c.updates}) for name, c in mconn.upmu_database.collections.iteritems())
+    results['options'] = vars(options)
+    if options.keep:
+        results['output'] = outputdir
+    return results
+
+def report(results):
+    print 'Files acknowledged: {0} ({1:.1f} files/s, {2:.1f} MB/s) over {3:.1f} s'.format(results['files'], results['files_per_sec'], results['mb_per_sec'], results['elapsed'])
+    print 'Unacknowledged at the end: {0}; wrong acknowledgements: {1}'.format(results['unacknowledged'], results['bad_acks'])
+    print 'Connections: {0} ({1} reconnects, {2} files resent, {3} failed connection attempts)'.format(results['connections'], results['reconnects'], results['resent'], results['connect_failures'])
+    print 'Injected: {0} gap(s), {1} duplicate(s)'.format(results['gaps'], results['duplicates'])
+    for name, unit in (('ack_latency', 'ms'), ('reactor_lag', 'ms')):
+        summary = results[name]
+        if summary['count']:
+            print '{0}: p50 {1:.1f} {5}, p90 {2:.1f} {5}, p99 {3:.1f} {5}, max {4:.1f} {5}'.format(name.replace('_', ' ').capitalize(), 1000 * summary['p50'], 1000 * summary['p90'], 1000 * summary['p99'], 1000 * summary['max'], unit)
+    print 'Peak RSS of the receiver: {0:.1f} MB'.format(results['peak_rss_mb'])
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-u', '--upmus', help='the number of simulated uPMUs', type=int, default=10)
+    argparser.add_argument('-r', '--rate', help='the number of files each uPMU sends per second', type=float, default=1.0)
+    argparser.add_argument('-d', '--duration', help='the number of seconds for which the uPMUs send files', type=float, default=30)
+    argparser.add_argument('--drain', help='the number of seconds to wait at the end for outstanding acknowledgements', type=float, default=30)
+    argparser.add_argument('--reconnect', help='the probability that a uPMU disconnects and reconnects after a file', type=float, default=0)
+    argparser.add_argument('--gaps', help='the probability that a file is missing some seconds', type=float, default=0)
+    argparser.add_argument('--duplicates', help='the probability that a file has a duplicated second', type=float, default=0)
+    argparser.add_argument('--mongolatency', help='the number of seconds the fake database takes to complete each write', type=float, default=0)
+    argparser.add_argument('-a', '--receiverargs', help='arguments for receivercsv.py, such as "-s 900 -f both"', default='-s 900')
+    argparser.add_argument('--seed', help='the seed for the random choices of the uPMUs', type=int, default=0)
+    argparser.add_argument('-o', '--output', help='a file in which to save the results as JSON')
+    argparser.add_argument('-k', '--keep', help='keep the files written by the receiver', action='store_true')
+    argparser.add_argument('--drive', help=argparse.SUPPRESS, action='store_true') # Run the simulated uPMUs
+    argparser.add_argument('--port', help=argparse.SUPPRESS, type=int)
+    options = argparser.parse_args()
+
+    if options.drive:
+        drive(options)
+        sys.exit(0)
+    results = run(options)
+    if results is None:
+        sys.exit(1)
+    report(results)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
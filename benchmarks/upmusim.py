@@ -0,0 +1,112 @@
+# Generates the same files as generateFile in upmu-sim/upmusim.go, so that
+# the benchmarks can run on realistic input without the simulator. Times are
+# in UTC, and the random phases come from numpy rather than Go's math/rand.
+
+import datetime
+import math
+import numpy as np
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parser import sync_output
+
+SAMPLES = 120 # per second
+SECONDS_PER_FILE = 120
+
+WEIERSTRASS_A = 0.5
+WEIERSTRASS_B = 15.0
+WEIERSTRASS_ITER = 20
+
+MAX_FLOAT32 = np.finfo(np.float32).max
+
+def clamp_float32(x):
+    """ Converts the array X to float32 as clampFloat32 does: infinities
+    become the largest finite values and NaNs become 0. """
+    y = np.asarray(x, dtype=np.float64).astype(np.float32)
+    y[np.isposinf(y)] = MAX_FLOAT32
+    y[np.isneginf(y)] = -MAX_FLOAT32
+    y[np.isnan(y)] = 0.0
+    return y
+
+def x2sinxinv(x):
+    return np.array([0.0 if v == 0.0 else v * v * math.sin(1 / v) for v in x])
+
+def xinvsinxinv(x):
+    return np.array([0.0 if v == 0.0 else (1 / v) * math.sin(1 / v) for v in x])
+
+def weierstrass(x):
+    fx = np.zeros(len(x))
+    aton = 1.0
+    bton = 1.0
+    for n in xrange(WEIERSTRASS_ITER):
+        aton *= WEIERSTRASS_A
+        bton *= WEIERSTRASS_B
+        fx += aton * np.cos(bton * math.pi * np.asarray(x))
+    return fx
+
+def _simpson(y, h):
+    return h / 3 * (y[0] + y[-1] + 4 * y[1:-1:2].sum() + 2 * y[2:-1:2].sum())
+
+def bessel_y(n, x):
+    """ Returns the Bessel function of the second kind Y_N(X), which Go has
+    as math.Yn but Python's math module lacks, from its integral form. """
+    if x == 0.0:
+        return float('-inf')
+    theta = np.linspace(0, math.pi, 2001)
+    first = _simpson(np.sin(x * np.sin(theta) - n * theta), theta[1])
+    t = np.linspace(0, math.asinh(200.0 / x), 20001)
+    second = _simpson((np.exp(n * t) + (-1) ** n * np.exp(-n * t)) * np.exp(-x * np.sinh(t)), t[1])
+    return (first - second) / math.pi
+
+_template = None
+
+def template():
+    """ Returns a sync_output with the fields that generateSecond sets to the
+    same values every second. """
+    global _template
+    if _template is None:
+        record = np.zeros(1, dtype=sync_output.DTYPE)
+        data = record['sync_data']
+        data['sampleRate'] = 1000.0 / 120.0
+        data['lockstate'] = 1
+        i = np.arange(SAMPLES, dtype=np.float64)
+        data['L1MagAng']['mag'] = clamp_float32(np.sin(i * 4.0 * math.pi / 120))
+        data['L2MagAng']['mag'] = clamp_float32(np.sin(i * 2.0 * math.pi / 120))
+        data['L3MagAng']['mag'] = clamp_float32(np.sin(i * 1.0 * math.pi / 120))
+        data['C1MagAng']['mag'] = clamp_float32([bessel_y(0, v * 15.0 / 120) for v in i])
+        data['C2MagAng']['mag'] = clamp_float32([bessel_y(1, v * 15.0 / 120) for v in i])
+        data['C3MagAng']['mag'] = clamp_float32([bessel_y(2, v * 15.0 / 120) for v in i])
+        data['C1MagAng']['angle'] = clamp_float32(x2sinxinv((i - 60) / 240))
+        data['C2MagAng']['angle'] = clamp_float32(xinvsinxinv((i - 60) / 120))
+        data['C3MagAng']['angle'] = clamp_float32(weierstrass((i - 60) / 60))
+        _template = record
+    return _template
+
+def generate_records(start_time, num_seconds, random=np.random):
+    """ Returns an array of NUM_SECONDS sync_outputs, one for each second
+    from START_TIME (in seconds since the epoch), drawing the random phases
+    from RANDOM, a numpy RandomState. """
+    records = np.repeat(template(), num_seconds)
+    data = records['sync_data']
+    for j in xrange(num_seconds):
+        data['times'][j] = datetime.datetime.utcfromtimestamp(start_time + j).timetuple()[:6]
+    data['L1MagAng']['angle'] = random.random_sample((num_seconds, SAMPLES)).astype(np.float32)
+    data['L2MagAng']['angle'] = clamp_float32(random.standard_normal((num_seconds, SAMPLES)))
+    data['L3MagAng']['angle'] = clamp_float32(random.standard_exponential((num_seconds, SAMPLES)))
+    return records
+
+def generate_file(start_time, random=np.random):
+    """ Returns the contents of a file of SECONDS_PER_FILE seconds starting at
+    START_TIME (in seconds since the epoch), as generateFile does. """
+    return generate_records(start_time, SECONDS_PER_FILE, random).tostring()
+
+def file_path(sendid):
+    return '/simulation/file{0}.dat'.format(sendid)
+
+def frame_message(sendid, filepath, serial, data):
+    """ Returns a message as simulatePmu sends it to the receiver. """
+    pad = lambda s: s + '\x00' * (((len(s) + 3) & 0xFFFFFFFC) - len(s))
+    return struct.pack('<IIII', sendid, len(filepath), len(serial), len(data)) + pad(filepath) + pad(serial) + data
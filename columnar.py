@@ -0,0 +1,101 @@
+# Reads and writes the compressed columnar files that receivercsv.py can
+# produce instead of (or as well as) CSV files.
+#
+# A file starts with a header giving the number of rows in each of its
+# sections (the records of the window, then duplicate records, then
+# misplaced records) and a table with the name, type and location of each
+# column. Each column is then stored as a separately compressed block, so a
+# reader only has to decompress the columns it asks for.
+import mmap
+import numpy as np
+import struct
+import zlib
+
+MAGIC = 'UPMUCOL1'
+EXTENSION = '.col'
+COMPRESSION_LEVEL = 6
+SECTIONS = ('normal', 'duplicate', 'early')
+
+HEADER = struct.Struct('<8sIIII') # magic, rows in each section, number of columns
+COLUMN_ENTRY = struct.Struct('<16s4sQQQ') # name, dtype, offset, compressed length, length
+
+class ColumnarFormatException(RuntimeError):
+    pass
+
+def encode_columnar(names, sections):
+    """ Returns the contents of a columnar file as a string. NAMES are the
+    names of the columns, and SECTIONS is a tuple of three lists of arrays
+    (the normal, duplicate and early rows), each with one array per column. """
+    counts = [len(section[0]) if section else 0 for section in sections]
+    blocks = []
+    entries = []
+    offset = HEADER.size + COLUMN_ENTRY.size * len(names)
+    for i, name in enumerate(names):
+        column = np.concatenate([section[i] for section in sections])
+        raw = column.astype(column.dtype.newbyteorder('<')).tostring()
+        block = zlib.compress(raw, COMPRESSION_LEVEL)
+        entries.append(COLUMN_ENTRY.pack(name, column.dtype.newbyteorder('<').str, offset, len(block), len(raw)))
+        blocks.append(block)
+        offset += len(block)
+    return HEADER.pack(MAGIC, counts[0], counts[1], counts[2], len(names)) + ''.join(entries) + ''.join(blocks)
+
+def write_columnar(filename, names, sections):
+    """ Writes a columnar file to FILENAME. The arguments are as for
+    encode_columnar. """
+    with open(filename, 'wb') as f:
+        f.write(encode_columnar(names, sections))
+
+class ColumnarFile(object):
+    """ A columnar file opened for reading. The file is memory-mapped, so
+    only the blocks of the columns that are read are loaded from disk. """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, normal, duplicate, early, numcolumns = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ColumnarFormatException('{0} is not a columnar file'.format(filename))
+            self.counts = dict(zip(SECTIONS, (normal, duplicate, early)))
+            self.names = []
+            self._entries = {}
+            for i in xrange(numcolumns):
+                name, dtype, offset, clength, length = COLUMN_ENTRY.unpack_from(self._map, HEADER.size + i * COLUMN_ENTRY.size)
+                name = name.rstrip('\x00')
+                self.names.append(name)
+                self._entries[name] = (np.dtype(dtype.rstrip('\x00')), offset, clength, length)
+        except:
+            self._map.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def column(self, name, section=None):
+        """ Returns the column called NAME as an array. If SECTION (one of
+        'normal', 'duplicate' or 'early') is given, only the rows of that
+        section are returned. """
+        if name not in self._entries:
+            raise KeyError('no column called {0}'.format(name))
+        dtype, offset, clength, length = self._entries[name]
+        data = np.frombuffer(zlib.decompress(self._map[offset:offset + clength]), dtype=dtype)
+        if len(data) * dtype.itemsize != length:
+            raise ColumnarFormatException('column {0} is corrupt'.format(name))
+        if section is None:
+            return data
+        start = 0
+        for s in SECTIONS:
+            if s == section:
+                return data[start:start + self.counts[s]]
+            start += self.counts[s]
+        raise ValueError('unknown section {0}'.format(section))
+
+def read_column(filename, name, section=None):
+    """ Returns the column called NAME from the columnar file FILENAME. """
+    with ColumnarFile(filename) as f:
+        return f.column(name, section)
@@ -9,8 +9,11 @@ import time
 
 from email.mime.text import MIMEText
 
-last_warning_check = datetime.datetime.utcnow() # when we last checked for warnings
+last_warning_check = datetime.datetime.utcnow() # the time of the newest warning summary seen
 last_email_time = last_warning_check # when we last sent messages
+last_received_check = None # the time of the newest entry of latest_time seen
+
+SUMMARY_LAG = datetime.timedelta(0, 60) # how far back to look for warning summaries saved late by the receiver
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--checktime', help='the number of seconds to wait after polling the database', type=int, default=300)
@@ -50,6 +53,13 @@ latest_time = client.upmu_database.latest_time
 warnings = client.upmu_database.warnings
 warnings_summary = client.upmu_database.warnings_summary
 
+latest_time.create_index('time_received')
+warnings.create_index([('serial_number', pymongo.ASCENDING), ('start_time', pymongo.ASCENDING)])
+warnings_summary.create_index('time')
+
+last_received = {} # maps each serial number to the time at which a message was last received from it
+seen_summaries = {} # maps the ids of recently seen warning summaries to their times
+
 inactive_serials = set()
 events = {} # maps each serial number to a list of EventMessages
 
@@ -143,12 +153,21 @@ class WarningMessage(EventMessage):
         elif self.description == 'misplaced':
             return 'WARNING: misplaced records(s) left uncorrected due to CSV boundary: new CSV file contains records from {0} to {1}, but would normally start at {2} (message generated at {3})'.format(self.start_time, self.end_time, self.prev_time, self.event_time)
 
-while True:
-    # Add messages to events queue
-    for document in latest_time.find(): # Check for inactivity
-        serialNumber = document['serial_number']
-        lastReceived = document['time_received']
-        if (datetime.datetime.utcnow() - lastReceived).total_seconds() < ALERTTIME:
+def check_activity():
+    """ Reads the entries of latest_time changed since the last check, and adds
+    events for the uPMUs that have become inactive or active again. """
+    global alert, last_received_check
+    if last_received_check is None:
+        changed = latest_time.find()
+    else:
+        changed = latest_time.find({'time_received': {'$gte': last_received_check}})
+    for document in changed:
+        last_received[document['serial_number']] = document['time_received']
+        if last_received_check is None or document['time_received'] > last_received_check:
+            last_received_check = document['time_received']
+    now = datetime.datetime.utcnow()
+    for serialNumber, lastReceived in last_received.iteritems():
+        if (now - lastReceived).total_seconds() < ALERTTIME:
             if serialNumber in inactive_serials: # if it's been fixed, mark it as active
                 inactive_serials.remove(serialNumber)
                 add_event(serialNumber, EventMessage('active', lastReceived))
@@ -156,17 +175,36 @@ while True:
             inactive_serials.add(serialNumber)
             add_event(serialNumber, EventMessage('inactive', lastReceived))
             alert = True
-    warning_check = datetime.datetime.utcnow() # The time of this warning check
-    for document in warnings_summary.find({'time': {'$gt': last_warning_check}}): # Check for warnings for missing/duplicate entries since the last time we checked
+
+def check_warnings():
+    """ Reads the warning summaries saved since the last check, and adds events
+    for the CSV files that were not written and for the warnings of those
+    with too many warnings, which are read together in one query. """
+    global last_warning_check
+    dense = []
+    for document in warnings_summary.find({'time': {'$gt': last_warning_check - SUMMARY_LAG}}).sort('time', pymongo.ASCENDING): # Check for warnings for missing/duplicate entries since the last time we checked
+        if document['_id'] in seen_summaries:
+            continue
+        seen_summaries[document['_id']] = document['time']
+        last_warning_check = max(last_warning_check, document['time'])
         if document['written']:
             # Check if the density of warnings is high enough to warrant an alert
             density = document['num_warnings'] / (document['next_csv_start'] - document['csv_start']).total_seconds()
             if density > DENSITY_THRESHOLD:
-                for doc in warnings.find({'serial_number': document['serial_number'], 'start_time': {'$gte': document['csv_start'], '$lt': document['next_csv_start']}}).sort('warning_time', pymongo.ASCENDING):
-                    add_event(doc['serial_number'], WarningMessage(doc['warning_type'], doc['warning_time'], doc['start_time'], doc.get('end_time', None), doc.get('prev_time', None)))
+                dense.append({'serial_number': document['serial_number'], 'start_time': {'$gte': document['csv_start'], '$lt': document['next_csv_start']}})
         else:
             add_event(document['serial_number'], WarningMessage('missing file', document['time'], document['csv_start'], document['next_csv_start'] - datetime.timedelta(0, 1), None))
-    last_warning_check = warning_check
+    for _id, summary_time in seen_summaries.items():
+        if summary_time <= last_warning_check - SUMMARY_LAG:
+            del seen_summaries[_id]
+    if dense:
+        for doc in warnings.find({'$or': dense}).sort('warning_time', pymongo.ASCENDING):
+            add_event(doc['serial_number'], WarningMessage(doc['warning_type'], doc['warning_time'], doc['start_time'], doc.get('end_time', None), doc.get('prev_time', None)))
+
+while True:
+    # Add messages to events queue
+    check_activity()
+    check_warnings()
     # Wait before checking again
     seconds = seconds_until_next_email()
     if seconds <= CHECKTIME:
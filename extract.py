@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Writes the CSV rows of one uPMU for a range of time, taken from the CSV
+# files written by receivercsv.py or backfill.py through the index that they
+# keep in the directory of each serial number (see archiveindex.py).
+
+import argparse
+import calendar
+import datetime
+import sys
+
+from archiveindex import extract
+from utils import firstrow
+
+def parse_time(string):
+    """ Parses STRING, either seconds since the epoch or a UTC time such as
+    '2015-01-01 00:00:00' (or a prefix of one, down to the day), into
+    seconds since the epoch. """
+    try:
+        return int(string)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H', '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(string, fmt).utctimetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('not a time: {0}'.format(string))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('serial', help='the serial number (or its alias, as in the name of its output directory)')
+parser.add_argument('start', help='the first second to extract, in seconds since the epoch or as a UTC time such as "2015-01-01 00:00:00"', type=parse_time)
+parser.add_argument('end', help='the second after the last one to extract', type=parse_time)
+parser.add_argument('-o', '--output', help='the directory in which the csv files are stored', default='output/')
+parser.add_argument('-w', '--write', help='a file to which to write the rows (by default, standard output)')
+parser.add_argument('--noheader', help='leave out the header row', action='store_true')
+args = parser.parse_args()
+
+OUTPUTDIR = args.output
+if args.output[-1] != '/':
+    OUTPUTDIR += '/'
+
+if __name__ == '__main__':
+    out = sys.stdout if args.write is None else open(args.write, 'wb')
+    if not args.noheader:
+        out.write(','.join(firstrow) + '\r\n')
+    rows = extract('{0}{1}/'.format(OUTPUTDIR, args.serial), args.start, args.end, out)
+    if out is not sys.stdout:
+        out.close()
+    print >>sys.stderr, 'Extracted {0} row(s)'.format(rows)
@@ -0,0 +1,72 @@
+# Splits the byte stream sent by sender.c into messages
+import struct
+
+HEADER_LENGTH = 16 # sendid, length of file path, length of serial number, length of data
+MAX_BODY_LENGTH = 64 * 1024 * 1024 # the largest body accepted before the stream is considered corrupt
+
+class FramingException(RuntimeError):
+    pass
+
+class Message(object):
+    def __init__(self, sendid, filepath, serialNum, data):
+        self.sendid = sendid
+        self.filepath = filepath
+        self.serialNum = serialNum
+        self.data = data
+
+class MessageFramer(object):
+    """ Reassembles messages from chunks of a TCP stream. Each chunk is
+    copied exactly once, into a bytearray that is preallocated once the header
+    of the message it belongs to has been read, so the cost of framing a
+    message is linear in its length no matter how it is split up. A chunk may
+    contain the end of one message and the beginning of the next. """
+    def __init__(self):
+        self._header = bytearray()
+        self._reset()
+
+    def _reset(self):
+        del self._header[:]
+        self._lengths = None
+        self._body = None
+        self._filled = 0
+
+    def pending(self):
+        """ Returns the number of bytes received that do not yet form a whole
+        message. """
+        return len(self._header) + self._filled
+
+    def feed(self, data):
+        """ Adds DATA to the stream. Returns a list of the Messages completed
+        by it, in the order in which they were sent. Raises a FramingException
+        if a header announces a body longer than MAX_BODY_LENGTH. """
+        messages = []
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if self._body is None:
+                n = min(HEADER_LENGTH - len(self._header), len(data) - offset)
+                self._header.extend(view[offset:offset + n].tobytes())
+                offset += n
+                if len(self._header) < HEADER_LENGTH:
+                    break
+                self._lengths = struct.unpack_from('<III', buffer(self._header), 4)
+                lengths, lengthserial, lengthd = self._lengths
+                bodylength = ((lengths + 3) & 0xFFFFFFFC) + ((lengthserial + 3) & 0xFFFFFFFC) + lengthd
+                if bodylength > MAX_BODY_LENGTH:
+                    raise FramingException('message body would be {0} bytes long (at most {1} allowed)'.format(bodylength, MAX_BODY_LENGTH))
+                self._body = bytearray(bodylength)
+            n = min(len(self._body) - self._filled, len(data) - offset)
+            self._body[self._filled:self._filled + n] = view[offset:offset + n]
+            self._filled += n
+            offset += n
+            if self._filled == len(self._body):
+                messages.append(self._message())
+                self._reset()
+        return messages
+
+    def _message(self):
+        lengths, lengthserial, lengthd = self._lengths
+        padding1 = ((lengths + 3) & 0xFFFFFFFC)
+        padding2 = ((lengthserial + 3) & 0xFFFFFFFC)
+        body = buffer(self._body)
+        return Message(str(self._header[:4]), str(body[:lengths]), str(body[padding1:padding1 + lengthserial]), str(body[padding1 + padding2:]))
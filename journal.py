@@ -0,0 +1,153 @@
+# An on-disk journal of the records waiting to be written to CSV files
+import errno
+import fcntl
+import json
+import numpy as np
+import os
+import struct
+import urllib
+
+from parser import parse_records, sync_output, times_to_epoch
+from txmongo._pymongo.objectid import ObjectId
+from utils import datetime_to_epoch, epoch_to_datetime
+
+ENTRY_HEADER = struct.Struct('<cI') # kind, length of payload
+STATE = 'S' # payload is the cycle start time and first file path, as JSON
+RECORDS = 'R' # payload is a mongo id (or spaces), then the raw records it applies to
+MONGOID = 'M' # payload is a mongo id, then the time of the last record of its file
+NO_MONGOID = ' ' * 24
+MONGOID_TIME = struct.Struct('<q')
+
+class PendingJournal(object):
+    """ Keeps, for each serial number, the state of the CSV window being
+    filled (the time at which it starts, the path of the first file in it,
+    and its records) in an append-only file under DIRECTORY, so that the
+    window can be restored after the uPMU reconnects or the receiver
+    restarts. Records are appended as they arrive; the file is rewritten
+    with only the remaining records whenever a window is written out. """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, serialNum, extension='.journal'):
+        return os.path.join(self.directory, urllib.quote(serialNum, '') + extension)
+
+    def __contains__(self, serialNum):
+        return os.path.exists(self._path(serialNum))
+
+    def lock(self, serialNum):
+        """ Tries to take an exclusive lock on the journal for SERIALNUM, so
+        that only one receiver process handles its uPMU at a time. Returns the
+        lock, to be passed to unlock, or None if someone else holds it. The
+        lock is released if the process exits. """
+        f = open(self._path(serialNum, '.lock'), 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ioe:
+            f.close()
+            if ioe.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return f
+
+    def unlock(self, lock):
+        lock.close()
+
+    def recover(self):
+        """ Checks every journal in the directory, cutting off any entry left
+        incomplete by a crash. Returns the serial numbers that have a
+        journal. """
+        serials = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.journal'):
+                continue
+            serialNum = urllib.unquote(filename[:-len('.journal')])
+            path = os.path.join(self.directory, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+            end = sum(ENTRY_HEADER.size + len(payload) for kind, payload in _entries(data))
+            if end != len(data):
+                print 'WARNING: discarding {0} bytes of incomplete entries from the journal for {1}'.format(len(data) - end, serialNum)
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+            serials.append(serialNum)
+        return serials
+
+    def append(self, serialNum, cycleTime, firstfilepath, records, mongoid):
+        """ Appends the current state of the window for SERIALNUM and
+        RECORDS, an array of sync_output.DTYPE received in one file, to its
+        journal. MONGOID is the id of the file's Mongo document, if any. """
+        with open(self._path(serialNum), 'ab') as f:
+            f.write(_state_entry(cycleTime, firstfilepath))
+            if len(records):
+                f.write(_records_entry(records, mongoid))
+
+    def rewrite(self, serialNum, cycleTime, firstfilepath, records, mongoids):
+        """ Replaces the journal for SERIALNUM with the given state, RECORDS,
+        an array of sync_output.DTYPE, and MONGOIDS, a list of pairs of the
+        time of the last record of a file and the id of its Mongo document. """
+        path = self._path(serialNum)
+        entries = [_state_entry(cycleTime, firstfilepath)]
+        if len(records):
+            entries.append(_records_entry(records, None))
+        for epoch, mongoid in mongoids:
+            entries.append(_entry(MONGOID, str(mongoid) + MONGOID_TIME.pack(epoch)))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(''.join(entries))
+        os.rename(path + '.tmp', path)
+
+    def load(self, serialNum):
+        """ Returns the state of the window for SERIALNUM as a tuple of its
+        start time, the path of its first file, its records as an array of
+        sync_output.DTYPE, and the pairs of the time of the last record of a
+        file and the id of its Mongo document, or None if SERIALNUM has no
+        journal. """
+        try:
+            with open(self._path(serialNum), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        cycleTime = None
+        firstfilepath = None
+        records = []
+        mongoids = []
+        for kind, payload in _entries(data):
+            if kind == STATE:
+                state = json.loads(payload)
+                cycleTime = None if state['cycle'] is None else epoch_to_datetime(state['cycle'])
+                firstfilepath = state['firstfilepath']
+                if firstfilepath is not None:
+                    firstfilepath = firstfilepath.encode('utf-8')
+            elif kind == RECORDS:
+                fileRecords = parse_records(payload[len(NO_MONGOID):])
+                if len(fileRecords) and payload[:len(NO_MONGOID)] != NO_MONGOID:
+                    mongoids.append((int(times_to_epoch(fileRecords[-1]['sync_data']['times'])), ObjectId(payload[:len(NO_MONGOID)])))
+                records.append(fileRecords)
+            elif kind == MONGOID:
+                mongoids.append((MONGOID_TIME.unpack(payload[len(NO_MONGOID):])[0], ObjectId(payload[:len(NO_MONGOID)])))
+        if records:
+            records = np.concatenate(records)
+        else:
+            records = np.zeros(0, dtype=sync_output.DTYPE)
+        return cycleTime, firstfilepath, records, mongoids
+
+def _entry(kind, payload):
+    return ENTRY_HEADER.pack(kind, len(payload)) + payload
+
+def _state_entry(cycleTime, firstfilepath):
+    cycle = None if cycleTime is None else datetime_to_epoch(cycleTime)
+    return _entry(STATE, json.dumps({'cycle': cycle, 'firstfilepath': firstfilepath}))
+
+def _records_entry(records, mongoid):
+    return _entry(RECORDS, (NO_MONGOID if mongoid is None else str(mongoid)) + records.tostring())
+
+def _entries(data):
+    """ Yields the complete entries in DATA as pairs of kind and payload. """
+    offset = 0
+    while offset + ENTRY_HEADER.size <= len(data):
+        kind, length = ENTRY_HEADER.unpack_from(data, offset)
+        if offset + ENTRY_HEADER.size + length > len(data):
+            return
+        yield kind, data[offset + ENTRY_HEADER.size:offset + ENTRY_HEADER.size + length]
+        offset += ENTRY_HEADER.size + length
@@ -1,74 +1,246 @@
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from SocketServer import ThreadingMixIn
+import argparse
+import collections
+import gzip
 import json
 import os
 import pymongo
 import requests
 import string
 import sys
+import threading
+import time
 import urllib
 
+from cStringIO import StringIO
+from twisted.internet import defer, reactor, threads
+from twisted.web import resource, server
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--port', help='the port at which to accept queries', type=int, default=4523)
+parser.add_argument('-t', '--ttl', help='the maximum number of seconds for which the metadata are cached before they are reloaded (0 to query the database every time)', type=float, default=300)
+parser.add_argument('-z', '--gzipsize', help='the minimum length in bytes of a response that is compressed, for clients that accept gzip', type=int, default=4096)
+parser.add_argument('-v', '--poll', help='the number of seconds between checks of whether the metadata have changed in the database', type=float, default=5)
+args = parser.parse_args()
+
+PORT = args.port
+TTL = args.ttl
+POLL = args.poll
+GZIPSIZE = args.gzipsize
+
 client = pymongo.MongoClient()
 mongo_collection = client.qdf.metadata
 
-class HTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write('GET request received')
-        
-    def do_POST(self):
-        self.query = self.rfile.read(int(self.headers['Content-Length']))
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET POST')
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        if self.query == 'select distinct Metadata/SourceName':
-            sources = set()
-            for stream in mongo_collection.find():
-                sources.add(stream['Metadata']['SourceName'])
-            self.wfile.write(json.dumps(list(sources)))
-        elif self.query.startswith('select distinct Path where Metadata/SourceName'):
-            source = self.query.split('"')[1]
-            paths = set()
-            for stream in mongo_collection.find({"$where": 'this.Metadata.SourceName === "{0}"'.format(source)}):
-                paths.add(stream['Path'])
-            self.wfile.write(json.dumps(list(paths)))
-        elif self.query.startswith('select * where Metadata/SourceName'):
-            parts = self.query.split('"')
-            source = parts[1]
-            path = parts[3]
-            streams = set()
-            for stream in mongo_collection.find({"$where": 'this.Metadata.SourceName === "{0}" && this.Path === "{1}"'.format(source, path)}):
-                del stream['_id']
-                streams.add(json.dumps(stream))
-            returnstr = '['
-            for stream in streams:
-                returnstr += stream + ", "
-            self.wfile.write(returnstr[:-2] + ']')
-        elif self.query.startswith('select * where uuid ='): # I assume that it's a sequence of ORs
-            parts = self.query.split('"')
-            uuids = []
-            i = 0
-            while i < len(parts):
-                if i % 2 != 0:
-                    uuids.append('this.uuid === "{0}"'.format(parts[i]))
-                i += 1
-            streams = set()
-            for stream in mongo_collection.find({"$where": ' || '.join(uuids)}):
-                del stream['_id']
-                streams.add(json.dumps(stream))
-            returnstr = '['
-            for stream in streams:
-                returnstr += stream + ", "
-            self.wfile.write(returnstr[:-2] + ']')
+mongo_collection.create_index([('Metadata.SourceName', pymongo.ASCENDING), ('Path', pymongo.ASCENDING)])
+mongo_collection.create_index('uuid')
+
+class MetadataSet(object):
+    """ The metadata of every stream, indexed by source name, by source name
+    and path, and by uuid, with each stream already serialized as JSON. """
+    def __init__(self, streams):
+        self.sources = []
+        self.paths = collections.OrderedDict() # Maps source names to their paths
+        self.by_path = {} # Maps (source name, path) to the JSON of its streams
+        self.by_uuid = {} # Maps uuids to the JSON of their streams
+        for stream in streams:
+            serialized = json.dumps(stream)
+            source = stream['Metadata']['SourceName']
+            if source not in self.paths:
+                self.sources.append(source)
+                self.paths[source] = []
+            if (source, stream['Path']) not in self.by_path:
+                self.paths[source].append(stream['Path'])
+                self.by_path[(source, stream['Path'])] = []
+            self.by_path[(source, stream['Path'])].append(serialized)
+            self.by_uuid.setdefault(stream.get('uuid'), []).append(serialized)
+        self.sources_json = json.dumps(self.sources)
+        self.paths_json = dict((source, json.dumps(paths)) for source, paths in self.paths.iteritems())
+
+    def select_paths(self, source):
+        return self.paths_json.get(source, '[]')
+
+    def select_streams(self, source, path):
+        return join_streams(self.by_path.get((source, path), []))
+
+    def select_uuids(self, uuids):
+        return join_streams(serialized for uuid in uuids for serialized in self.by_uuid.get(uuid, []))
+
+class MetadataCache(object):
+    """ Holds a MetadataSet loaded from the database. It is reloaded once it
+    is TTL seconds old, or sooner if a check, made at most every POLL
+    seconds, finds that the collection has changed. """
+    def __init__(self, ttl, poll):
+        self.ttl = ttl
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.metadata = None
+        self.version = None
+        self.loaded = 0
+        self.checked = 0
+
+    def fresh(self):
+        """ Returns True if get can return without going to the database. """
+        now = time.time()
+        return self.metadata is not None and now - self.loaded < self.ttl and now - self.checked < self.poll
+
+    def get(self):
+        """ Returns an up-to-date MetadataSet. """
+        if self.fresh():
+            return self.metadata
+        with self.lock:
+            now = time.time()
+            if self.metadata is None or now - self.loaded >= self.ttl:
+                self._load(collection_version())
+            elif now - self.checked >= self.poll:
+                version = collection_version()
+                if version != self.version:
+                    self._load(version)
+                self.checked = now
+            return self.metadata
+
+    def _load(self, version):
+        self.metadata = MetadataSet(mongo_collection.find({}, {'_id': False}))
+        self.version = version
+        self.loaded = self.checked = time.time()
+
+def collection_version():
+    """ Returns the number of documents in the metadata collection and the
+    largest _id among them, which change whenever streams are added or
+    removed, or None if the database cannot be asked. Both come from an
+    index, so checking is cheap; a change to an existing document is only
+    picked up once the cache is TTL seconds old. """
+    global version_failed
+    try:
+        last = list(mongo_collection.find({}, {'_id': True}).sort('_id', pymongo.DESCENDING).limit(1))
+        return mongo_collection.estimated_document_count(), last[0]['_id'] if last else None
+    except pymongo.errors.PyMongoError as pe:
+        if not version_failed:
+            print 'WARNING: could not check whether the metadata have changed; they are reloaded every {0} seconds instead'.format(TTL)
+            print 'Details:', pe
+            version_failed = True
+        return None
+
+version_failed = False # Whether collection_version has failed, so that it is only reported once
+
+def join_streams(serialized):
+    """ Returns a JSON list of the distinct streams in SERIALIZED, a sequence
+    of streams already serialized as JSON. """
+    return '[' + ', '.join(collections.OrderedDict.fromkeys(serialized)) + ']'
+
+def select_sources():
+    if cache is not None:
+        return cache.get().sources_json
+    return json.dumps(mongo_collection.distinct('Metadata.SourceName'))
+
+def select_paths(source):
+    if cache is not None:
+        return cache.get().select_paths(source)
+    return json.dumps(mongo_collection.find({'Metadata.SourceName': source}).distinct('Path'))
+
+def select_streams(source, path):
+    if cache is not None:
+        return cache.get().select_streams(source, path)
+    return join_streams(json.dumps(stream) for stream in mongo_collection.find({'Metadata.SourceName': source, 'Path': path}, {'_id': False}))
+
+def select_uuids(uuids):
+    if cache is not None:
+        return cache.get().select_uuids(uuids)
+    return join_streams(json.dumps(stream) for stream in mongo_collection.find({'uuid': {'$in': uuids}}, {'_id': False}))
+
+def answer(query):
+    """ Returns the response to QUERY as a JSON string. """
+    if query == 'select distinct Metadata/SourceName':
+        return select_sources()
+    elif query.startswith('select distinct Path where Metadata/SourceName'):
+        return select_paths(query.split('"')[1])
+    elif query.startswith('select * where Metadata/SourceName'):
+        parts = query.split('"')
+        return select_streams(parts[1], parts[3])
+    elif query.startswith('select * where uuid ='): # I assume that it's a sequence of ORs
+        return select_uuids(query.split('"')[1::2])
+    else:
+        return '[]'
+
+def answer_batch(queries):
+    """ Returns the responses to QUERIES, a list of queries, as a JSON list. """
+    return '[' + ', '.join(answer(query) for query in queries) + ']'
+
+def respond(func, *args):
+    """ Calls FUNC with ARGS in the reactor thread if the answer is in the
+    cache, and otherwise in a thread so that the database is not waited for
+    in the reactor thread. Returns a Deferred that fires with the result. """
+    if cache is not None and cache.fresh():
+        return defer.maybeDeferred(func, *args)
+    return threads.deferToThread(func, *args)
+
+def compress(data):
+    f = StringIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as g:
+        g.write(data)
+    return f.getvalue()
+
+if TTL > 0:
+    cache = MetadataCache(TTL, POLL)
+else:
+    cache = None
+
+class MetadataResource(resource.Resource):
+    """ Answers a query posted to any path, or a JSON list of queries posted
+    to /batch with a JSON list of their answers. """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'text/html')
+        return 'GET request received'
+
+    def render_POST(self, request):
+        query = request.content.read()
+        if request.postpath == ['batch']:
+            try:
+                queries = json.loads(query)
+                if not isinstance(queries, list) or not all(isinstance(q, basestring) for q in queries):
+                    raise ValueError('not a list of queries')
+            except ValueError as ve:
+                request.setResponseCode(400)
+                request.setHeader('Content-type', 'text/plain')
+                return 'Could not read batch: {0}'.format(ve)
+            d = respond(answer_batch, [q.encode('utf-8') for q in queries])
+        else:
+            d = respond(answer, query)
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d.addCallback(self._finish, request, finished)
+        d.addErrback(self._fail, request, finished)
+        return server.NOT_DONE_YET
+
+    def _finish(self, response, request, finished):
+        if finished:
+            return # The client went away
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'GET POST')
+        request.setHeader('Content-type', 'text/html')
+        request.setHeader('Vary', 'Accept-Encoding')
+        if len(response) >= GZIPSIZE and 'gzip' in (request.getHeader('Accept-Encoding') or ''):
+            d = threads.deferToThread(compress, response) # Large responses would hold up the reactor
+            d.addCallback(self._write, request, finished, 'gzip')
+            d.addErrback(self._fail, request, finished)
         else:
-            self.wfile.write('[]')
-                    
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    pass
-        
-serv = ThreadedHTTPServer(('', 4523), HTTPRequestHandler)
-serv.serve_forever()
+            self._write(response, request, finished)
+
+    def _write(self, response, request, finished, encoding=None):
+        if finished:
+            return
+        if encoding is not None:
+            request.setHeader('Content-Encoding', encoding)
+        request.setHeader('Content-Length', str(len(response)))
+        request.write(response)
+        request.finish()
+
+    def _fail(self, err, request, finished):
+        print 'ERROR: could not answer query:', err.getErrorMessage()
+        if finished:
+            return
+        request.setResponseCode(500)
+        request.finish()
+
+reactor.listenTCP(PORT, server.Site(MetadataResource()))
+reactor.run()
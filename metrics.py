@@ -0,0 +1,158 @@
+# Counters, gauges and histograms that receivercsv.py keeps about its work,
+# and a twisted.web resource that serves them in the Prometheus text format
+import bisect
+import time
+
+from twisted.internet import task
+from twisted.web import resource
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def lines(self):
+        yield '# HELP {0} {1}'.format(self.name, self.description)
+        yield '# TYPE {0} {1}'.format(self.name, self.kind)
+        for line in self.samples():
+            yield line
+
+class Counter(Metric):
+    """ A count that only goes up, kept separately for each combination of
+    values of its labels. """
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        Metric.__init__(self, name, description, labels)
+        self.values = {}
+
+    def inc(self, amount=1, *labelvalues):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        for labelvalues in sorted(self.values):
+            yield '{0}{1} {2}'.format(self.name, _labels(self.labels, labelvalues), _number(self.values[labelvalues]))
+
+class Gauge(Metric):
+    """ A value read from FUNCTION, which returns a number, or a dict mapping
+    tuples of label values to numbers, whenever the metrics are served. """
+    kind = 'gauge'
+
+    def __init__(self, name, description, function, labels=()):
+        Metric.__init__(self, name, description, labels)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labelvalues in sorted(value):
+            yield '{0}{1} {2}'.format(self.name, _labels(self.labels, labelvalues), _number(value[labelvalues]))
+
+class Histogram(Metric):
+    """ Counts observations (usually durations in seconds) in cumulative
+    buckets with the upper bounds in BUCKETS. """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # Maps label values to the counts in each bucket (and above the last), and the sum
+
+    def observe(self, value, *labelvalues):
+        if labelvalues not in self.values:
+            self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = self.values[labelvalues]
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    def since(self, start, *labelvalues):
+        """ Observes the time elapsed since START, a time.time(). """
+        self.observe(time.time() - start, *labelvalues)
+
+    def time_deferred(self, d, *labelvalues):
+        """ Observes the time until D fires, and returns D. """
+        start = time.time()
+        def observe(result):
+            self.since(start, *labelvalues)
+            return result
+        return d.addBoth(observe)
+
+    def samples(self):
+        for labelvalues in sorted(self.values):
+            counts, total = self.values[labelvalues]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(self.name, _labels(self.labels, labelvalues, [('le', _number(bound))]), cumulative)
+            yield '{0}_sum{1} {2}'.format(self.name, _labels(self.labels, labelvalues), _number(total))
+            yield '{0}_count{1} {2}'.format(self.name, _labels(self.labels, labelvalues), cumulative)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def gauge(self, name, description, function, labels=()):
+        return self._add(Gauge(name, description, function, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """ Returns all metrics in the Prometheus text format. """
+        return '\n'.join(line for metric in self.metrics for line in metric.lines()) + '\n'
+
+class ReactorLag(object):
+    """ Observes in HISTOGRAM how late the reactor runs a timer scheduled
+    every INTERVAL seconds. """
+    def __init__(self, histogram, interval=0.1):
+        self.histogram = histogram
+        self.interval = interval
+        self.last = None
+        self.loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        self.last = time.time()
+        self.loop.start(self.interval, now=False)
+
+    def _tick(self):
+        now = time.time()
+        self.histogram.observe(max(now - self.last - self.interval, 0))
+        self.last = now
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.exposition()
@@ -6,38 +6,99 @@ import argparse
 import datetime
 import math
 import pymongo
+import time
 
 parser = argparse.ArgumentParser()
-parser.add_argument('serialnum', help='the serial number of the uPMU to check on')
+parser.add_argument('serialnum', help='the serial number of the uPMU to check on', nargs='?')
 parser.add_argument('-c', '--criticaltime', help='the minimum number of seconds for which inactivity should result in a critical alert; defaults to 20 minutes', type=int, default=1200)
 parser.add_argument('-w', '--warningtime', help='the minimum number of seconds for which inactivity should result in a warning alert; defaults to one-half the critical time threshold', type=int)
+parser.add_argument('-b', '--batch', help='check every uPMU listed in this file, one per line as "host;service description;serial number", optionally followed by ";warning time;critical time", and submit the results as passive check results')
+parser.add_argument('-x', '--commandfile', help='in batch mode, the Nagios external command file to which results are written', default='/var/lib/nagios3/rw/nagios.cmd')
+parser.add_argument('-m', '--mongo', help='the host of the Mongo Database', default='128.32.37.231')
 args = parser.parse_args()
 
+if (args.serialnum is None) == (args.batch is None):
+    parser.error('give either a serial number or --batch')
+
+def default_warningtime(criticaltime):
+    warningtime = criticaltime / 2
+    if warningtime == 0:
+        warningtime = 1
+    return warningtime
+
 if args.warningtime is None:
-    args.warningtime = args.criticaltime / 2
-    if args.warningtime == 0:
-        args.warningtime = 1
-        
+    args.warningtime = default_warningtime(args.criticaltime)
+
+def check(doc, serialnum, warningtime, criticaltime):
+    """ Returns the status code and output of the check of the uPMU with
+    serial number SERIALNUM, given DOC, its document in latest_time. """
+    if doc is None:
+        return 3, 'Unknown - no document for a uPMU with serial number "{0}" was found in the Mongo Database'.format(serialnum)
+    time_received = doc['time_received']
+    delta = (datetime.datetime.utcnow() - time_received).total_seconds()
+    if delta >= criticaltime:
+        return 2, 'Critical - last message from uPMU was received at {0} (UTC)'.format(time_received)
+    elif delta >= warningtime:
+        return 1, 'Warning - last message from uPMU was last received at {0} (UTC)'.format(time_received)
+    else:
+        return 0, 'OK - last message from uPMU was last received at {0} (UTC)'.format(time_received)
+
+def read_batch(filename):
+    """ Returns a list of the checks in FILENAME, each a tuple of host,
+    service description, serial number, warning time and critical time. """
+    checks = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(';')]
+            if len(fields) == 3:
+                checks.append((fields[0], fields[1], fields[2], args.warningtime, args.criticaltime))
+            elif len(fields) == 5:
+                checks.append((fields[0], fields[1], fields[2], int(fields[3]), int(fields[4])))
+            else:
+                raise ValueError('could not read line "{0}" of {1}'.format(line, filename))
+    return checks
+
 try:
-    client = pymongo.MongoClient('128.32.37.231')
+    client = pymongo.MongoClient(args.mongo)
     latest_time = client.upmu_database.latest_time
 except:
     print 'Unknown - could not start Mongo DB'
     exit(3)
 
-doc = latest_time.find_one({"serial_number": args.serialnum})
-if doc is None:
-    print 'Unknown - no document for a uPMU with serial number "{0}" was found in the Mongo Database'.format(args.serialnum)
+if args.batch is None:
+    code, output = check(latest_time.find_one({"serial_number": args.serialnum}), args.serialnum, args.warningtime, args.criticaltime)
+    print output
+    exit(code)
+
+try:
+    checks = read_batch(args.batch)
+except (IOError, ValueError) as e:
+    print 'Unknown - could not read batch file:', e
+    exit(3)
+
+try:
+    docs = dict((doc['serial_number'], doc) for doc in latest_time.find({'serial_number': {'$in': [serialnum for host, service, serialnum, warningtime, criticaltime in checks]}}))
+except pymongo.errors.PyMongoError as pme:
+    print 'Unknown - could not query Mongo DB:', pme
+    exit(3)
+
+now = int(time.time())
+lines = []
+counts = [0, 0, 0, 0]
+for host, service, serialnum, warningtime, criticaltime in checks:
+    code, output = check(docs.get(serialnum), serialnum, warningtime, criticaltime)
+    lines.append('[{0}] PROCESS_SERVICE_CHECK_RESULT;{1};{2};{3};{4}\n'.format(now, host, service, code, output))
+    counts[code] += 1
+
+try:
+    with open(args.commandfile, 'a') as f:
+        f.write(''.join(lines))
+except IOError as ioe:
+    print 'Unknown - could not write to command file {0}: {1}'.format(args.commandfile, ioe)
     exit(3)
 
-time_received = doc['time_received']
-delta = (datetime.datetime.utcnow() - time_received).total_seconds()
-if delta >= args.criticaltime:
-    print 'Critical - last message from uPMU was received at {0} (UTC)'.format(time_received)
-    exit(2)
-elif delta >= args.warningtime:
-    print 'Warning - last message from uPMU was last received at {0} (UTC)'.format(time_received)
-    exit(1)
-else:
-    print 'OK - last message from uPMU was last received at {0} (UTC)'.format(time_received)
-    exit(0)
+print 'OK - submitted {0} check result(s): {1} OK, {2} warning, {3} critical, {4} unknown'.format(len(checks), *counts)
+exit(0)
@@ -1,7 +1,12 @@
+import numpy as np
 import struct
 
+class ParseException(RuntimeError):
+    pass
+
 class sync_point(object):
     LENGTH = 8
+    DTYPE = np.dtype([('angle', '<f4'), ('mag', '<f4')])
     def __init__(self, *data):
         assert len(data) == 2, 'wrong number of fields (expected 2, got {0})'.format(len(data))
         assert [float, float] == map(type, data), 'wrong types of arguments'
@@ -9,6 +14,10 @@ class sync_point(object):
     
 class sync_output_msgq(object):
     LENGTH = 508 + (720 * sync_point.LENGTH)
+    DTYPE = np.dtype([('sampleRate', '<f4'), ('times', '<i4', (6,)), ('lockstate', '<i4', (120,)),
+                      ('L1MagAng', sync_point.DTYPE, (120,)), ('L2MagAng', sync_point.DTYPE, (120,)),
+                      ('L3MagAng', sync_point.DTYPE, (120,)), ('C1MagAng', sync_point.DTYPE, (120,)),
+                      ('C2MagAng', sync_point.DTYPE, (120,)), ('C3MagAng', sync_point.DTYPE, (120,))])
     def __init__(self, *data):
         assert len(data) == 9, 'wrong number of fields (expected 9, got {0})'.format(len(data))
         assert float == type(data[0]), 'wrong types of arguments'
@@ -20,6 +29,7 @@ class sync_output_msgq(object):
     
 class sync_pll_stats_msgq(object):
     LENGTH = 16
+    DTYPE = np.dtype([('ppl_state', '<u4'), ('pps_prd', '<u4'), ('curr_err', '<i4'), ('center_frq_offset', '<i4')])
     def __init__(self, *data):
         assert len(data) == 4, 'wrong number of fields (expected 4, got {0})'.format(len(data))
         assert [int, int, int, int] == map(type, data), 'wrong types of arguments'
@@ -27,6 +37,7 @@ class sync_pll_stats_msgq(object):
     
 class sync_gps_stats(object):
     LENGTH = 28
+    DTYPE = np.dtype([(name, '<f4') for name in ('alt', 'lat', 'hdop', 'lon', 'satellites', 'state', 'hasFix')])
     def __init__(self, *data):
         assert len(data) == 7, 'wrong number of fields (expected 7, got {0})'.format(len(data))
         assert [float for _ in xrange(7)] == map(type, data), 'wrong types of arguments'
@@ -34,14 +45,82 @@ class sync_gps_stats(object):
         
 class sync_output(object):
     LENGTH = sync_output_msgq.LENGTH + sync_pll_stats_msgq.LENGTH + sync_gps_stats.LENGTH
+    DTYPE = np.dtype([('sync_data', sync_output_msgq.DTYPE), ('pll_stats', sync_pll_stats_msgq.DTYPE), ('gps_stats', sync_gps_stats.DTYPE)])
     def __init__(self, *data):
         assert len(data) == 3, 'wrong number of fields (expected 3, got {0})'.format(len(data))
         assert [sync_output_msgq, sync_pll_stats_msgq, sync_gps_stats] == map(type, data), 'wrong types of arguments'
         self.sync_data, self.pll_stats, self.gps_stats = data
         self.mongoid = None
         
+# Views that expose records of a sync_output.DTYPE array through the same
+# attributes as the structs above, decoding fields only when they are accessed
+
+class sync_point_seq(object):
+    """ A read-only sequence of sync_points backed by an array of sync_point.DTYPE. """
+    def __init__(self, arr):
+        self._arr = arr
+    def __len__(self):
+        return len(self._arr)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[j] for j in xrange(*i.indices(len(self._arr))))
+        angle, mag = self._arr[i].item()
+        return sync_point(angle, mag)
+    def __iter__(self):
+        for angle, mag in self._arr.tolist():
+            yield sync_point(angle, mag)
+
+class sync_output_msgq_view(object):
+    LENGTH = sync_output_msgq.LENGTH
+    def __init__(self, record):
+        self._record = record
+        self.times = tuple(record['times'].tolist())
+    @property
+    def sampleRate(self):
+        return float(self._record['sampleRate'])
+    @property
+    def lockstate(self):
+        return tuple(self._record['lockstate'].tolist())
+    L1MagAng = property(lambda self: sync_point_seq(self._record['L1MagAng']))
+    L2MagAng = property(lambda self: sync_point_seq(self._record['L2MagAng']))
+    L3MagAng = property(lambda self: sync_point_seq(self._record['L3MagAng']))
+    C1MagAng = property(lambda self: sync_point_seq(self._record['C1MagAng']))
+    C2MagAng = property(lambda self: sync_point_seq(self._record['C2MagAng']))
+    C3MagAng = property(lambda self: sync_point_seq(self._record['C3MagAng']))
+
+class sync_output_view(object):
+    LENGTH = sync_output.LENGTH
+    def __init__(self, records, index, epoch=None):
+        self.records = records
+        self.index = index
+        record = records[index]
+        if epoch is None:
+            epoch = int(times_to_epoch(record['sync_data']['times']))
+        self.epoch = epoch # the time of the record in seconds since the epoch
+        self.sync_data = sync_output_msgq_view(record['sync_data'])
+        self.pll_stats = sync_pll_stats_msgq(*map(int, record['pll_stats'].item()))
+        self.gps_stats = sync_gps_stats(*record['gps_stats'].item())
+        self.mongoid = None
+    @property
+    def data(self):
+        return self.records[self.index:self.index + 1].tostring()
+        
 # Functions to parse strings into structs
 
+def times_to_epoch(times):
+    """ Converts TIMES, an array of time[] arrays, into an array of seconds
+    since the epoch. """
+    times = np.asarray(times, dtype=np.int64)
+    year, month, day = times[..., 0], times[..., 1], times[..., 2]
+    # Count days from the epoch, treating January and February as the last months of the previous year
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    yoe = year - 400 * era
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    doe = 365 * yoe + yoe // 4 - yoe // 100 + doy
+    days = 146097 * era + doe - 719468
+    return 86400 * days + 3600 * times[..., 3] + 60 * times[..., 4] + times[..., 5]
+
 def parse_sync_point(string):
     """ Parses the beginning of STRING as a sync_point. Returns the
     corresponding sync_point object and the remainder of the string. """
@@ -75,13 +154,38 @@ def parse_sync_gps_stats(string):
     return sync_gps_stats(*struct.unpack('<fffffff', string[:28])), string[28:]
     
 def parse_sync_output(string):
-    """ Parses the beginning of STRING as a sync_output. Returns the
-    corresponding sync_output object and the remainder of the string. """
-    orig_string = string
-    f1, string = parse_sync_output_msgq(string)
-    f2, string = parse_sync_pll_stats_msgq(string)
-    f3, string = parse_sync_gps_stats(string)
-    output = sync_output(f1, f2, f3)
-    output.data = orig_string
-    return output, string
-
+    """ Parses the beginning of STRING as a sync_output. Returns a
+    sync_output_view of it and the remainder of the string. """
+    records = np.frombuffer(string, dtype=sync_output.DTYPE, count=1)
+    return sync_output_view(records, 0), string[sync_output.LENGTH:]
+    
+def decode_sync_outputs(string):
+    """ Decodes STRING, which must contain a whole number of sync_outputs, into
+    an array of sync_output.DTYPE records. The array shares memory with STRING. """
+    return np.frombuffer(string, dtype=sync_output.DTYPE)
+    
+def sync_output_views(records):
+    """ Returns a list of sync_output_views, one for each record in RECORDS. """
+    epochs = times_to_epoch(records['sync_data']['times']).tolist()
+    return [sync_output_view(records, i, epochs[i]) for i in xrange(len(records))]
+    
+def stack_records(views):
+    """ Returns an array of sync_output.DTYPE containing the records behind
+    the sync_output_views in VIEWS, in the same order. """
+    return np.array([view.records[view.index] for view in views], dtype=sync_output.DTYPE)
+    
+def parse_records(string):
+    """ Decodes STRING like decode_sync_outputs, but raises a ParseException
+    if it does not contain a whole number of sync_outputs. """
+    if len(string) % sync_output.LENGTH != 0:
+        raise ParseException('Input to \"parse\" does not contain whole number of \"sync_output\"s ({0} extra bytes)'.format(len(string) % sync_output.LENGTH))
+    return decode_sync_outputs(string)
+    
+def parse(string):
+    """ Parses data (in the form of STRING) into a series of sync_output
+    objects. Returns a list of sync_output_views. If STRING is not of a
+    suitable length (i.e., if the number of bytes is not some multiple of
+    the length of a sync_output struct) a ParseException is raised. The
+    records are decoded in place, so the time taken is linear in the length
+    of STRING. """
+    return sync_output_views(parse_records(string))
@@ -0,0 +1,72 @@
+# A content-addressed store for the raw .dat files received from uPMUs
+import errno
+import hashlib
+import mmap
+import os
+import thread
+
+FSYNC_POLICIES = ('none', 'file', 'dir')
+
+class RawStore(object):
+    """ Stores payloads as files under ROOT, named by the SHA-256 hash of
+    their contents and sharded into two levels of subdirectories by the first
+    four hex digits of the hash. Storing a payload that is already present
+    does nothing. FSYNC is one of FSYNC_POLICIES: with 'file', each new file
+    is flushed to disk before it is renamed into place; with 'dir', the
+    directory holding it is flushed as well, so the new entry survives a
+    crash; with 'none', neither is. """
+    def __init__(self, root, fsync='file'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy must be one of {0}'.format(', '.join(FSYNC_POLICIES)))
+        self.root = root
+        self.fsync = fsync
+
+    def path(self, digest):
+        """ Returns the path of the file holding the payload with hash DIGEST. """
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + '.dat')
+
+    def put(self, data):
+        """ Stores DATA and returns its hash. """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+        temppath = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), thread.get_ident()) # Unique to the thread, as the receiver stores files in several
+        with open(temppath, 'wb') as f:
+            f.write(data)
+            if self.fsync != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(temppath, path)
+        if self.fsync == 'dir':
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return digest
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def map(self, digest):
+        """ Returns a read-only memory map of the payload with hash DIGEST. It
+        can be passed to parser.decode_sync_outputs without copying it. The
+        caller should close it when done. An empty payload is returned as an
+        empty string instead. Raises an IOError if the payload is not in the
+        store. """
+        with open(self.path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, digest):
+        """ Returns the payload with hash DIGEST as a string. """
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
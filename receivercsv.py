@@ -2,26 +2,41 @@
 
 import argparse
 import bson
-import calendar
+import collections
 import csv
 import datetime
+import errno
+import numpy as np
 import os
+import signal
 import socket
 import struct
+import subprocess
+import sys
 import thread
 import threading
+import time
 import traceback
 import txmongo
+import txmongo.filter
 
 
-from math import floor
-from parser import sync_output, parse_sync_output
+from framing import FramingException, MessageFramer
+from journal import PendingJournal
+from metrics import MetricsResource, ReactorLag, Registry
+from parser import sync_output, parse, parse_records, times_to_epoch, ParseException
+from rawstore import RawStore, FSYNC_POLICIES
+from rollups import encode_rollups
 from sys import argv
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.internet.protocol import Protocol, Factory
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.python import failure
+from twisted.web.server import Site
 from txmongo._pymongo.binary import Binary
 from utils import *
+from windowbuffer import WindowBuffer
+from workers import encode_rows, encode_window, write_indexed, write_partial, CompressorPool, SerialQueue, WorkerException, WorkerPool
 
 # Maps serial numbers to their aliases
 aliases = {}
@@ -30,7 +45,7 @@ parsed = [] # Stores parsed sync_output structs
 
 mongoids = [] # Stores ids of mongo documents
 
-pending = {}
+pending = collections.OrderedDict() # Maps serial numbers of disconnected uPMUs to the state of their CSV window
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
@@ -38,22 +53,86 @@ parser.add_argument('-s', '--seconds', help='the number of seconds per output cs
 parser.add_argument('-d', '--depth', help='the depth of the files in the directory structure being sent (top level is at depth 0)', type=int, default=4)
 parser.add_argument('-o', '--output', help='the directory in which to store the csv files', default='output/')
 parser.add_argument('-p', '--port', help='the port at which to accept incoming messages', type=int, default=1883)
-args = parser.parse_args()
+parser.add_argument('-b', '--batchsize', help='the number of Mongo writes of each kind to collect before sending them together', type=int, default=1000)
+parser.add_argument('-t', '--batchtime', help='the maximum number of seconds for which a Mongo write is held back to be sent with others', type=float, default=1.0)
+parser.add_argument('-r', '--rawstore', help='a directory in which to store the raw files, named by hash; if given, Mongo documents hold only the hash instead of the data')
+parser.add_argument('--fsync', help='when storing raw files, whether to flush each file (file), each file and its directory (dir), or nothing (none) to disk', choices=FSYNC_POLICIES, default='file')
+parser.add_argument('-j', '--journal', help='a directory in which to keep the records of unfinished csv files, so that they survive restarts')
+parser.add_argument('-m', '--maxpending', help='with --journal, the number of disconnected uPMUs whose unfinished csv files are also kept in memory', type=int, default=100)
+parser.add_argument('-f', '--format', help='the format of the output files: csv, compressed columnar files, or both', choices=('csv', 'columnar', 'both'), default='csv')
+parser.add_argument('--maxinflight', help='the number of files received on one connection that may wait for Mongo before reading from it is paused (0 for no limit)', type=int, default=16)
+parser.add_argument('--maxinflightbytes', help='the number of bytes received on one connection that may wait for Mongo before reading from it is paused (0 for no limit)', type=int, default=64 * 1024 * 1024)
+parser.add_argument('--maxtotalinflight', help='the number of files received on all connections that may wait for Mongo before reading from all of them is paused (0 for no limit)', type=int, default=1000)
+parser.add_argument('--maxtotalinflightbytes', help='the number of bytes received on all connections that may wait for Mongo before reading from all of them is paused (0 for no limit)', type=int, default=1024 * 1024 * 1024)
+parser.add_argument('-n', '--processes', help='the number of receiver processes, which share the port; with more than one (and --seconds), --journal is required so that a uPMU can reconnect to any of them', type=int, default=1)
+parser.add_argument('--child', help=argparse.SUPPRESS, type=int) # The index of a receiver process started by the supervisor
+parser.add_argument('--metricsport', help='a port on localhost at which to serve metrics in the Prometheus text format (with --processes, each process uses the next port after the previous one)', type=int)
+parser.add_argument('-z', '--gzip', help='the gzip compression level (1-9) of the csv files, which are then named .csv.gz (0 to write them uncompressed)', type=int, choices=range(10), default=0)
+parser.add_argument('--compressors', help='with --gzip, the number of threads that compress csv files (0 to compress them in the main thread)', type=int, default=2)
+parser.add_argument('--rollups', help='whether to compute per-second and per-minute statistics of each window and write them next to its output files (files), upsert the per-minute ones into the rollups collection (mongo), or both', choices=('none', 'files', 'mongo', 'both'), default='none')
+parser.add_argument('-w', '--workers', help='the number of processes in which to encode output files (which are then written from a thread pool); with 0, files are encoded and written in the main thread', type=int, default=0)
 
-if args.seconds == -1:
-    NUM_SECONDS_PER_FILE = 900
-    write_csv = False
-else:
-    NUM_SECONDS_PER_FILE = args.seconds
-    write_csv = True
+def configure(arguments=None):
+    """ Sets the options of the receiver from ARGUMENTS, a list of command
+    line arguments (by default, those of this process). """
+    global args, NUM_SECONDS_PER_FILE, write_csv, DIRDEPTH, OUTPUTDIR, ADDRESSP, OUTPUTFORMAT, rawstore, NUM_PROCESSES, journal, MAXPENDING, BATCHSIZE, BATCHTIME, NUM_WORKERS, flow, METRICSPORT, GZIPLEVEL, NUM_COMPRESSORS, CSV_EXTENSION, ROLLUPS
+    args = parser.parse_args(arguments)
 
-DIRDEPTH = args.depth
+    if args.seconds == -1:
+        NUM_SECONDS_PER_FILE = 900
+        write_csv = False
+    else:
+        NUM_SECONDS_PER_FILE = args.seconds
+        write_csv = True
 
-OUTPUTDIR = args.output
-if args.output[-1] != '/':
-    OUTPUTDIR += '/'
+    DIRDEPTH = args.depth
 
-ADDRESSP = args.port
+    OUTPUTDIR = args.output
+    if args.output[-1] != '/':
+        OUTPUTDIR += '/'
+
+    ADDRESSP = args.port
+
+    OUTPUTFORMAT = args.format
+
+    if args.rawstore is None:
+        rawstore = None
+    else:
+        rawstore = RawStore(args.rawstore, args.fsync)
+
+    NUM_PROCESSES = args.processes
+
+    if args.journal is None or not write_csv:
+        journal = None
+        if NUM_PROCESSES > 1 and write_csv:
+            parser.error('--processes above 1 requires --journal')
+    else:
+        journal = PendingJournal(args.journal)
+
+    if NUM_PROCESSES > 1:
+        MAXPENDING = 0 # Another process may have changed the journal since
+    else:
+        MAXPENDING = args.maxpending
+
+    BATCHSIZE = args.batchsize
+    BATCHTIME = args.batchtime
+
+    NUM_WORKERS = args.workers
+
+    GZIPLEVEL = args.gzip
+    NUM_COMPRESSORS = args.compressors
+    CSV_EXTENSION = '.csv.gz' if GZIPLEVEL > 0 else '.csv'
+
+    ROLLUPS = args.rollups
+    if ROLLUPS in ('mongo', 'both') and NUM_SECONDS_PER_FILE % 60 != 0:
+        parser.error('--rollups mongo requires --seconds to be a multiple of 60, so that no minute is split between windows')
+
+    METRICSPORT = args.metricsport
+    if METRICSPORT is not None and args.child is not None:
+        METRICSPORT += args.child
+    
+    # Limits the files waiting for the database
+    flow = FlowControl(args.maxinflight, args.maxinflightbytes, args.maxtotalinflight, args.maxtotalinflightbytes)
 
 currtime = datetime.datetime.utcnow()
 
@@ -64,14 +143,41 @@ received_files = None
 latest_time = None
 warnings = None
 warnings_summary = None
+rollups = None
+
+# Write batchers for the warnings and received_files collections (will be set later)
+warning_writes = None
+publish_writes = None
+
+# Pools in which output files are encoded and written, and the queue that keeps the writes for each serial number in order (will be set later)
+workers = None
+write_queue = None
+store_queue = None # Keeps the raw files of each serial number, stored in threads with --rawstore, in order
+compressors = None # The pool that compresses CSV files, with --gzip
+streamfailed = set() # The names of windows whose CSV rows could not all be written as they arrived
+unwritten = {} # Maps serial numbers to the windows queued to be written, kept in the journal until they are
 
-# The first row of every csv file has lables
-firstrow = ['time', 'lockstate']
-for start in ('L', 'C'):
-    for num in xrange(1, 4):
-        for end in ('Ang', 'Mag'):
-            firstrow.append('{0}{1}{2}'.format(start, num, end))
-firstrow.extend(['satellites', 'hasFix'])
+connections = set() # The connected TCPResolvers
+
+# Metrics, served at --metricsport
+registry = Registry()
+files_received = registry.counter('upmu_files_received_total', 'Files received, by serial number', ('serial',))
+bytes_received = registry.counter('upmu_bytes_received_total', 'Bytes of data received, by serial number', ('serial',))
+registry.gauge('upmu_connections', 'Open connections', lambda: len(connections))
+registry.gauge('upmu_connected_serials', 'Serial numbers with an open connection', lambda: len(set(c.serialNum for c in connections if c.serialNum is not None)))
+registry.gauge('upmu_pending_serials', 'Serial numbers of disconnected uPMUs whose CSV windows are kept in memory', lambda: len(pending))
+registry.gauge('upmu_inflight_files', 'Files waiting for their Mongo insert', lambda: flow.files)
+registry.gauge('upmu_inflight_bytes', 'Bytes in files waiting for their Mongo insert', lambda: flow.bytes)
+registry.gauge('upmu_paused_connections', 'Connections paused until Mongo inserts complete', lambda: len(flow.paused))
+registry.gauge('upmu_queued_window_serials', 'Serial numbers with output files waiting to be encoded or written', lambda: len(write_queue) if write_queue is not None else 0)
+parse_seconds = registry.histogram('upmu_parse_seconds', 'Time taken to parse a file')
+mongo_seconds = registry.histogram('upmu_mongo_seconds', 'Time taken by Mongo writes, by collection and operation', ('collection', 'operation'))
+ack_seconds = registry.histogram('upmu_ack_seconds', 'Time from receiving a file to acknowledging it')
+window_seconds = registry.histogram('upmu_window_flush_seconds', 'Time from queueing the output files of a window to having written them')
+compress_input_bytes = registry.counter('upmu_compress_input_bytes_total', 'Bytes of CSV data compressed')
+compress_output_bytes = registry.counter('upmu_compress_output_bytes_total', 'Bytes of compressed CSV data produced')
+compress_seconds = registry.histogram('upmu_compress_seconds', 'Time from queueing CSV data to be compressed to having compressed it')
+reactor_lag_seconds = registry.histogram('upmu_reactor_lag_seconds', 'How late the reactor runs a timer')
 
 class ConnectionTerminatedException(RuntimeError):
     pass
@@ -79,310 +185,392 @@ class ConnectionTerminatedException(RuntimeError):
 class DatabaseException(RuntimeError):
     pass
     
-class ParseException(RuntimeError):
-    pass
-
-def parse(string):
-    """ Parses data (in the form of STRING) into a series of sync_output
-    objects. Returns a list of sync_output objects. If STRING is not of a
-    suitable length (i.e., if the number of bytes is not some multiple of
-    the length of a sync_output struct) a ParseException is raised. """
-    if len(string) % sync_output.LENGTH != 0:
-        raise ParseException('Input to \"parse\" does not contain whole number of \"sync_output\"s ({0} extra bytes)'.format(len(string) % sync_output.LENGTH))
-    lst = []
-    while string:
-        obj, string = parse_sync_output(string)
-        lst.append(obj)
-    return lst
-    
 class TCPResolver(Protocol):
     def __init__(self):
-        self._parsed = []
-        self.firstfilepath = None
+        self.window = WindowBuffer(NUM_SECONDS_PER_FILE) # The records of the current CSV window, its start and the path of its first file
         self.serialNum = None
-        self.cycleTime = None # The time at which this cycle starts
+        self.lock = None # The lock on the journal for the serial number, with more than one process
+        self.lost = False
+        self.inflight = 0 # The number of files not yet stored or whose Mongo insert has not completed
+        self.inflightbytes = 0 # The number of bytes in them
         
     def dataReceived(self, data):
-        self.have += data
-        if self.sendid is None:
-            if len(self.have) >= 4:
-                self.sendid = self.have[:4]
-                self.have = self.have[4:]
-            else:
-                return
-        if self.lengths is None:
-            if len(self.have) >= 12:
-                self.lengths, self.lengthserial, self.lengthd = struct.unpack('<III', self.have[:12])
-                self.padding1 = ((self.lengths + 3) & 0xFFFFFFFC)
-                self.padding2 = ((self.lengthserial + 3) & 0xFFFFFFFC)
-                self.have = self.have[12:]
-            else:
-                return
-        if self.filepath is None:
-            if len(self.have) >= self.lengths:
-                self.filepath = self.have[:self.lengths]
-                self.have = self.have[self.padding1:]
-            else:
-                return
-        if not self.gotSerialNum:
-            if len(self.have) >= self.lengthserial:
-                newSerial = self.have[:self.lengthserial]
-                if self.serialNum is not None and newSerial != self.serialNum:
-                    print 'WARNING: serial number changed from {0} to {1}'.format(self.serialNum, newSerial)
-                    print 'Updating serial number for next write'
-                self.serialNum = newSerial
-                self.gotSerialNum = True
-                self.have = self.have[self.padding2:]
-            else:
-                return
-        if self.data is None:
-            if len(self.have) >= self.lengthd:
-                self.data = self.have[:self.lengthd]
-                self.have = self.have[self.lengthd:]
-                if self.have:
-                    print 'WARNING: got {0} extra bytes'.format(len(self.have))
-                    self.have = ''
-            else:
+        try:
+            messages = self.framer.feed(data)
+        except FramingException as fe:
+            print 'ERROR: could not read message from {0}: {1}'.format(self.transport.getPeer(), fe)
+            print 'Closing connection'
+            self.transport.loseConnection()
+            return
+        for message in messages:
+            if not self._claim(message.serialNum):
+                print 'WARNING: serial number {0} is being handled by another receiver process'.format(message.serialNum)
+                print 'Closing connection'
+                self.transport.loseConnection()
                 return
-        # if we've reached this point, we have all the data
-        print 'Received {0}: serial number is {1}'.format(self.filepath, self.serialNum), '({0}),'.format(aliases.get(self.serialNum, 'alias not known')), 'length is {0}'.format(len(self.data))
-        self._processdata()
-        self._setup()
+            if self.serialNum is not None and message.serialNum != self.serialNum:
+                print 'WARNING: serial number changed from {0} to {1}'.format(self.serialNum, message.serialNum)
+                print 'Updating serial number for next write'
+            self.serialNum = message.serialNum
+            self.sendid = message.sendid
+            self.filepath = message.filepath
+            self.data = message.data
+            print 'Received {0}: serial number is {1}'.format(self.filepath, self.serialNum), '({0}),'.format(aliases.get(self.serialNum, 'alias not known')), 'length is {0}'.format(len(self.data))
+            files_received.inc(1, self.serialNum)
+            bytes_received.inc(len(self.data), self.serialNum)
+            self._processdata()
+            self._setup()
             
     def connectionLost(self, reason):
         print 'Connection lost:', self.transport.getPeer()
-        pending[self.serialNum] = (self.cycleTime, self.firstfilepath, self._parsed)
+        connections.discard(self)
+        pending[self.serialNum] = self.window # Files still being added finish it here, as the window holds all of its state
+        if journal is not None:
+            while len(pending) > MAXPENDING:
+                pending.popitem(last=False) # Still in the journal
+        self.lost = True
+        flow.forget(self)
+        self._unlock()
         
     def connectionMade(self):
-        self.have = ''
+        self.framer = MessageFramer()
         self._setup()
+        connections.add(self)
         print 'Connected:', self.transport.getPeer()
         
+    def _claim(self, serialNum):
+        """ With more than one receiver process, takes the lock on the journal
+        for SERIALNUM so that no other process handles the same uPMU while this
+        connection does. Returns False if the lock is held elsewhere. """
+        if NUM_PROCESSES == 1 or journal is None or (serialNum == self.serialNum and self.lock is not None):
+            return True
+        lock = journal.lock(serialNum)
+        if lock is None:
+            return False
+        if self.lock is not None:
+            self._release(self.lock, self.serialNum)
+        self.lock = lock
+        return True
+        
+    def _unlock(self, result=None):
+        """ Releases the lock on the journal once the connection is lost and
+        every file received on it has been added to the journal. """
+        if self.lost and self.inflight == 0 and self.lock is not None:
+            self._release(self.lock, self.serialNum)
+            self.lock = None
+        return result
+
+    def _release(self, lock, serialNum):
+        """ Releases LOCK, the lock on the journal for SERIALNUM, once the
+        output files queued for it have been written, so that the process
+        that takes it over does not start the same files while they are. """
+        write_queue.wait(serialNum).addCallback(lambda ignored: journal.unlock(lock))
+        
+    def _settled(self, result, length):
+        flow.finished(self, length)
+        return self._unlock(result)
+        
     def _setup(self):
         self.sendid = None
-        self.lengths = None
-        self.lengthserial = None
-        self.lengthd = None
         self.filepath = None
-        self.gotSerialNum = False
         self.data = None
         
     def _processdata(self):
+        received = time.time()
         if self.serialNum in pending:
-            if self._parsed:
+            if len(self.window):
                 print 'WARNING: multiple uPMUs with the same serial number appear to be connected simultaneously'
-            self.cycleTime, self.firstfilepath, self._parsed = pending[self.serialNum] # Restore from previous session
+            self.window = pending[self.serialNum] # Restore from previous session
             del pending[self.serialNum]
-        if self.firstfilepath is None: # To handle the very first file received
-            self.firstfilepath = self.filepath
+        elif journal is not None and self.window.start is None and not len(self.window) and self.serialNum in journal:
+            try:
+                cycleTime, firstfilepath, records, mongoids = journal.load(self.serialNum) # Restore from the journal
+                self.window.move(None if cycleTime is None else datetime_to_epoch(cycleTime))
+                self.window.restore(records, mongoids)
+                self.window.firstfilepath = firstfilepath
+                print 'Restored {0} record(s) for serial number {1} from journal'.format(len(self.window), self.serialNum)
+            except BaseException as be:
+                print 'WARNING: could not restore journal for serial number', self.serialNum
+                print 'Details:', be
+        if self.window.firstfilepath is None: # To handle the very first file received
+            self.window.firstfilepath = self.filepath
         received_file = {'name': self.filepath,
-                         'data': Binary(self.data),
                          'published': False,
                          'time_received': datetime.datetime.utcnow(),
                          'serial_number': self.serialNum}
+        flow.started(self, len(self.data))
+        if rawstore is None:
+            received_file['data'] = Binary(self.data)
+            d = defer.succeed(received_file)
+        else:
+            # Hashed and written in a thread, one file of a uPMU after another so that they reach Mongo in order
+            d = store_queue.run(self.serialNum, threads.deferToThread, rawstore.put, self.data)
+            d.addCallback(self._stored, received_file, len(self.data))
+        d.addCallbacks(self._insertfile, self._storefailed, callbackArgs=(self.data, self.sendid, self.filepath, received), errbackArgs=(self.filepath,))
+        d.addBoth(self._settled, len(self.data))
+
+    def _stored(self, digest, received_file, length):
+        received_file['sha256'] = digest
+        received_file['length'] = length
+        return received_file
+
+    def _storefailed(self, err, filepath):
+        print 'ERROR: could not store file', filepath, 'in', rawstore.root
+        print 'Details:', err.getErrorMessage()
+        self.transport.write('\x00\x00\x00\x00')
+
+    def _insertfile(self, received_file, data, sendid, filepath, received):
+        """ Adds RECEIVED_FILE, the document for the file at FILEPATH holding
+        DATA, to Mongo, and acknowledges it with SENDID once it is there.
+        Returns a Deferred that fires once that is done. """
         docsDeferred = latest_time.update({'serial_number': self.serialNum}, {'$set': {'time_received': received_file['time_received']}}, upsert = True)
-        docsDeferred.addErrback(latest_time_error, self.serialNum, self.filepath)
+        mongo_seconds.time_deferred(docsDeferred, 'latest_time', 'update')
+        docsDeferred.addErrback(latest_time_error, self.serialNum, filepath)
+        start = time.time()
         try:
-            parseddata = parse(self.data)
+            records = parse_records(data)
+            parse_seconds.since(start)
         except:
-            print 'ERROR: file', self.filepath, 'does not contain a whole number of sync_outputs. Ignoring file.'
+            print 'ERROR: file', filepath, 'does not contain a whole number of sync_outputs. Ignoring file.'
             self.transport.write('\x00\x00\x00\x00')
             mongoiddeferred = received_files.insert(received_file)
             return
-        if write_csv and (self.cycleTime is None):
+        if write_csv and (self.window.start is None):
             try:
-                secsFromBase = (datetime.datetime(*parseddata[0].sync_data.times) - BASETIME).total_seconds()
-                self.cycleTime = BASETIME + datetime.timedelta(0, secsFromBase - (secsFromBase % NUM_SECONDS_PER_FILE))
+                self.window.move(window_start(datetime_to_epoch(datetime.datetime(*records[0]['sync_data']['times'].tolist())), NUM_SECONDS_PER_FILE, BASETIME))
             except:
-                print 'WARNING:', self.filepath, 'has an invalid date'
+                print 'WARNING:', filepath, 'has an invalid date'
         mongoiddeferred = received_files.insert(received_file)
-        mongoiddeferred.addCallback(self._finishprocessing, parseddata, self.sendid)
-        mongoiddeferred.addErrback(databaseerror, self.transport, self.filepath)
+        mongo_seconds.time_deferred(mongoiddeferred, 'received_files', 'insert')
+        mongoiddeferred.addCallback(self._finishprocessing, records, sendid, filepath, received)
+        mongoiddeferred.addErrback(databaseerror, self.transport, filepath)
+        return mongoiddeferred
         
-    def _finishprocessing(self, mongoid, parseddata, sendid):
+    def _finishprocessing(self, mongoid, records, sendid, filepath, received):
         print 'Successfully added file to database'
         self.transport.write(sendid)
+        ack_seconds.since(received)
         print 'Sent confirmation of receipt ({0})'.format(repr(sendid))
-        parseddata[-1].mongoid = mongoid
-        if write_csv:
-            self._parsed.extend(parseddata)
-            latest_time = parseddata[0].sync_data.times
-            for parsed in parseddata:
-                if parsed.sync_data.times > latest_time:
-                    latest_time = parsed.sync_data.times
-            latest_time = datetime.datetime(*latest_time)
-            while (latest_time - self.cycleTime).total_seconds() >= NUM_SECONDS_PER_FILE:
-                try:
-                    self._writecsv()
-                except BaseException as be:
-                    print 'Could not write to CSV file'
-                    print 'Details:', be
+        if write_csv and len(records):
+            self.window.add(records, mongoid)
+            self._journal('append', records, mongoid)
+            latest_time = int(times_to_epoch(records['sync_data']['times']).max())
+            if latest_time - self.window.start >= NUM_SECONDS_PER_FILE:
+                while latest_time - self.window.start >= NUM_SECONDS_PER_FILE:
+                    try:
+                        self._writecsv(filepath)
+                    except BaseException as be:
+                        print 'Could not write to CSV file'
+                        print 'Details:', be
+                self._rewritejournal()
+            self._streamcsv()
+                
+    def _journal(self, operation, *args):
+        """ Records the state of the current CSV window in the journal using
+        the method of the journal called OPERATION, if there is a journal. """
+        if journal is None:
+            return
+        cycleTime, firstfilepath = self._cycletime(), self.window.firstfilepath
+        if unwritten.get(self.serialNum):
+            start, firstfilepath = unwritten[self.serialNum][0][:2] # Restore from the first window not yet written
+            cycleTime = epoch_to_datetime(start)
+        try:
+            getattr(journal, operation)(self.serialNum, cycleTime, firstfilepath, *args)
+        except BaseException as be:
+            print 'WARNING: could not update journal for serial number', self.serialNum
+            print 'Details:', be
+
+    def _rewritejournal(self):
+        """ Rewrites the journal with the records of the windows queued to be
+        written and of the current window. """
+        if journal is None:
+            return
+        queued = unwritten.get(self.serialNum, [])
+        records, mongoids = self.window.records()
+        records = np.concatenate([window[2] for window in queued] + [records])
+        mongoids = [pair for window in queued for pair in window[3]] + mongoids
+        self._journal('rewrite', records, mongoids)
             
-    def _writecsv(self):
-        """ Attempts to write data in self._parsed to CSV file. Upon success, updates the mongo
-        database to indicate that their data have been published and returns True. Upon failure,
-        returns False. If a cycle has been skipped, moves to the next cycle and does nothing."""
-        success = True
-        if not self._parsed:
+    def _writecsv(self, nextfilepath):
+        """ Attempts to write data in self.window to CSV file. NEXTFILEPATH is the path of the
+        file whose data triggered the write. The file is encoded and written by the worker pools,
+        after any earlier files for the same serial number; upon success, the mongo database is
+        updated to indicate that their data have been published. Returns a Deferred that fires
+        with True upon success and False upon failure. If a cycle has been skipped, moves to the
+        next cycle and does nothing."""
+        if not len(self.window):
             return
-        self._parsed.sort(key=lambda x: x.sync_data.times)
-        nextCycleTime = self.cycleTime + datetime.timedelta(0, NUM_SECONDS_PER_FILE)
-        dates = tuple(datetime.datetime(*s.sync_data.times) for s in self._parsed)
-        i = binsearch(dates, nextCycleTime)
-        while dates[i] >= nextCycleTime and i >= 0:
-            i -= 1
-        i += 1
-        if i == 0:
-            d = warnings_summary.insert({'serial_number': self.serialNum, 'time': datetime.datetime.utcnow(), 'csv_start': self.cycleTime, 'next_csv_start': nextCycleTime, 'num_warnings': 1, 'written': False})
+        cycleTime = self._cycletime()
+        nextCycleTime = cycleTime + datetime.timedelta(0, NUM_SECONDS_PER_FILE)
+        streamed = self.window.streamed
+        start = self.window.start
+        mongoidtimes = [(epoch, mongoid) for epoch, mongoid in self.window.mongoids if epoch < start + NUM_SECONDS_PER_FILE]
+        records, epochs, mongoids = self.window.take()
+        if len(records) == 0:
+            d = mongo_seconds.time_deferred(warnings_summary.insert({'serial_number': self.serialNum, 'time': datetime.datetime.utcnow(), 'csv_start': cycleTime, 'next_csv_start': nextCycleTime, 'num_warnings': 1, 'written': False}), 'warnings_summary', 'insert')
             d.addErrback(print_mongo_error, 'warning summary')
-            print 'WARNING: missing record(s) (no data from {0} to {1}, no CSV file written)'.format(self.cycleTime, nextCycleTime - datetime.timedelta(0, 1))
-            self.cycleTime = nextCycleTime
+            print 'WARNING: missing record(s) (no data from {0} to {1}, no CSV file written)'.format(cycleTime, nextCycleTime - datetime.timedelta(0, 1))
             return
-        parsedcopy = self._parsed[:i]
-        self._parsed = self._parsed[i:]
-        filepath = self.firstfilepath
-        self.firstfilepath = self.filepath # We've received the next CSV already.
+        filepath = self.window.firstfilepath
+        self.window.firstfilepath = nextfilepath # We've received the next CSV already.
         try:
-            parsedcopy.sort(key=lambda x: x.sync_data.times)
-            num_warnings = self._check_duplicates(dates[:i], nextCycleTime)
-            firstTime = time_to_str(parsedcopy[0].sync_data.times)
-            lastTime = time_to_str(parsedcopy[-1].sync_data.times)
-            dirtowrite = '{0}{1}/'.format(OUTPUTDIR, aliases.get(self.serialNum, self.serialNum))
-            subdirs = filepath.rsplit('/', DIRDEPTH + 1)
-            if subdirs[-1].endswith('.dat'):
-                subdirs[-1] = subdirs[-1][:-4]
-            if len(subdirs) <= DIRDEPTH + 1:
-                print 'WARNING: filepath {0} has insufficient depth'.format(filepath)
-            dirtowrite += '/'.join(subdirs[1:-1])
-            if not os.path.exists(dirtowrite):
-                os.makedirs(dirtowrite)
-            filename = '{0}/{1}__{2}__{3}.csv'.format(dirtowrite, self.serialNum, self.cycleTime, nextCycleTime - datetime.timedelta(0, 1))
-            with open(filename, 'wb') as f:
-                writer = csv.writer(f)
-                writer.writerow(firstrow)
-                early, normal, duplicate = self._lst_to_rows(parsedcopy)
-                writer.writerows(normal)
-                writer.writerow([])
-                if duplicate:
-                    writer.writerow(['Duplicate records (entries for same times exist in this CSV file):'])
-                    writer.writerows(duplicate)
-                    writer.writerow([])
-                if early:
-                    writer.writerow(['Misplaced records (should be in earlier CSV file):'])
-                    writer.writerows(early)
-            print 'Successfully wrote file', filename
-            d = warnings_summary.insert({'serial_number': self.serialNum, 'time': datetime.datetime.utcnow(), 'csv_start': self.cycleTime, 'next_csv_start': nextCycleTime, 'num_warnings': num_warnings, 'written': True})
-            d.addErrback(print_mongo_error, 'warning summary')
-        except KeyboardInterrupt:
-            success = False
+            num_warnings = self._check_duplicates(epochs, cycleTime, nextCycleTime)
+            filename = self._filename(filepath, cycleTime)
+            data = records.tostring()
         except BaseException as be:
-            success = False
-            print 'WARNING: write could not be completed due to exception'
-            print 'Details: {0}'.format(be)
-            print 'Traceback:'
-            traceback.print_exc()
-        finally:
-            self.cycleTime = nextCycleTime
-            if success:
-                for struct in parsedcopy:
-                    if struct.mongoid is not None:
-                        d = received_files.update({'_id': struct.mongoid}, {'$set': {'published': True}})
-                        d.addErrback(print_mongo_error, 'write')
-                return True
-            return False
-            
-    def _lst_to_rows(self, parsed):
-        earlyRecords = []
-        rows = [[] for _ in xrange(120 * NUM_SECONDS_PER_FILE)]
-        duplicates = []
-        for s in parsed:
-            stime = datetime.datetime(*s.sync_data.times)
-            basetime = time_to_nanos(stime)
-            early = False
-            duplicate = False
-            j = int(floor((stime - self.cycleTime).total_seconds() + 0.5)) # Floor it first because it might be negative
-            if j < 0:
-                early = True
-            elif rows[120 * j]:
-                duplicate = True
-            # it seems s.sync_data.sampleRate is the number of milliseconds between samples
-            timedelta = 1000000 * s.sync_data.sampleRate # nanoseconds between samples
-            for i in xrange(120):
-                row = []
-                row.append(basetime + int((i * timedelta) + 0.5))
-                row.append(s.sync_data.lockstate[i])
-                for start in ('L', 'C'):
-                    for num in xrange(1, 4):
-                        attribute = getattr(s.sync_data, '{0}{1}MagAng'.format(start, num))
-                        row.append(attribute[i].angle)
-                        row.append(attribute[i].mag)
-                row.append(s.gps_stats.satellites)
-                row.append(s.gps_stats.hasFix)
-                if early:
-                    earlyRecords.append(row)
-                elif duplicate:
-                    duplicates.append(row)
-                else:
-                    rows[(120 * j) + i] = row
-        return earlyRecords, rows, duplicates
+            write_failed(be)
+            return defer.succeed(False)
+        unwritten.setdefault(self.serialNum, []).append((start, filepath, records, mongoidtimes))
+        d = window_seconds.time_deferred(write_queue.run(self.serialNum, self._writewindow, data, cycleTime, filename, streamed))
+        d.addCallback(self._windowwritten, mongoids, cycleTime, nextCycleTime, num_warnings)
+        d.addErrback(write_failed)
+        return d
+
+    def _cycletime(self):
+        """ Returns the start of the current CSV window as a datetime, or None
+        if it is not yet known. """
+        if self.window.start is None:
+            return None
+        return epoch_to_datetime(self.window.start)
+
+    def _serialdir(self):
+        return '{0}{1}/'.format(OUTPUTDIR, aliases.get(self.serialNum, self.serialNum))
+
+    def _filename(self, filepath, cycleTime):
+        return window_filename(self._serialdir(), filepath, DIRDEPTH, self.serialNum, cycleTime, cycleTime + datetime.timedelta(0, NUM_SECONDS_PER_FILE))
+
+    def _writewindow(self, *args):
+        """ Writes the first window queued for the serial number by calling
+        _encodewindow with ARGS, then leaves its records out of the journal,
+        whether or not it could be written. """
+        d = defer.maybeDeferred(self._encodewindow, *args)
+        d.addBoth(self._windowdone)
+        return d
+
+    def _windowdone(self, result):
+        queued = unwritten[self.serialNum]
+        queued.pop(0)
+        if not queued:
+            del unwritten[self.serialNum]
+        self._rewritejournal()
+        return result
+
+    def _encodewindow(self, records, cycleTime, filename, streamed):
+        if filename in streamfailed:
+            streamfailed.discard(filename)
+            streamed = 0 # Write the whole file again
+        d = workers.run(encode_window, records, datetime_to_epoch(cycleTime), NUM_SECONDS_PER_FILE, OUTPUTFORMAT, streamed)
+        d.addCallback(compress_files)
+        if ROLLUPS != 'none':
+            rd = workers.run(encode_rollups, records, datetime_to_epoch(cycleTime), NUM_SECONDS_PER_FILE)
+            rd.addCallback(self._rollupsencoded)
+            d = defer.gatherResults([d, rd], consumeErrors=True)
+            d.addCallback(lambda (files, rollupfiles): files + rollupfiles)
+        d.addCallback(lambda files: workers.write(write_indexed, filename, files, (CSV_EXTENSION,) if streamed else (), self._serialdir(), datetime_to_epoch(cycleTime), NUM_SECONDS_PER_FILE))
+        return d
+
+    def _rollupsencoded(self, result):
+        """ Upserts the per-minute statistics in RESULT, as returned by
+        encode_rollups, into the rollups collection if asked to. Returns the
+        files of statistics to write with the window, if any. Windows are
+        whole minutes (see configure), so each minute is upserted whole. """
+        files, minutes = result
+        if ROLLUPS in ('mongo', 'both'):
+            for minute in minutes:
+                minute['time'] = epoch_to_datetime(minute['time'])
+                d = rollups.update({'serial_number': self.serialNum, 'time': minute['time']}, {'$set': minute}, upsert = True)
+                mongo_seconds.time_deferred(d, 'rollups', 'update')
+                d.addErrback(print_mongo_error, 'rollups')
+        if ROLLUPS in ('files', 'both'):
+            return files
+        return []
+
+    def _streamcsv(self):
+        """ Queues the rows of the seconds of the current window that have
+        arrived in order since the last call to be added to its unfinished
+        CSV file, so that _writecsv has only the rest to write. """
+        if OUTPUTFORMAT not in ('csv', 'both') or self.window.start is None:
+            return
+        try:
+            filename = self._filename(self.window.firstfilepath, self._cycletime())
+        except BaseException as be:
+            write_failed(be)
+            return
+        first = self.window.streamed == 0
+        records = self.window.stream()
+        if not len(records):
+            return
+        d = write_queue.run(self.serialNum, self._appendrows, records.tostring(), filename, first)
+        d.addErrback(write_failed)
+
+    def _appendrows(self, records, filename, first):
+        d = workers.run(encode_rows, records, first)
+        d.addCallback(compress_csv)
+        d.addCallback(lambda contents: workers.write(write_partial, filename, CSV_EXTENSION, contents, first))
+        d.addErrback(self._streamfailed, filename)
+        return d
+
+    def _streamfailed(self, err, filename):
+        """ Marks the CSV file FILENAME to be written whole by _encodewindow,
+        before the next work queued for the serial number can start. """
+        streamfailed.add(filename)
+        return err
+
+    def _windowwritten(self, written, mongoids, cycleTime, nextCycleTime, num_warnings):
+        for filename in written:
+            print 'Successfully wrote file', filename
+        warning_writes.flush() # So that the warnings are in the database before their summary
+        d = mongo_seconds.time_deferred(warnings_summary.insert({'serial_number': self.serialNum, 'time': datetime.datetime.utcnow(), 'csv_start': cycleTime, 'next_csv_start': nextCycleTime, 'num_warnings': num_warnings, 'written': True}), 'warnings_summary', 'insert')
+        d.addErrback(print_mongo_error, 'warning summary')
+        for mongoid in mongoids:
+            publish_writes.update(mongoid, {'$set': {'published': True}})
+        return True
             
-    def _check_duplicates(self, dates, nextCycleTime):
+    def _check_duplicates(self, epochs, cycleTime, nextCycleTime):
         """ Returns the total number of duplicates/missing/misplaced records found, and adds warnings to
-        Mongo DB as necessary. """
-        # DATES is assumed to be in sorted order
+        Mongo DB as necessary. CYCLETIME is the start of the window being checked. """
+        # EPOCHS is assumed to be in sorted order
         # Check if the structs have duplicates or missing items, print warnings and update Mongo if so
-        if not dates:
+        if len(epochs) == 0:
             return 0
         num_records = 0
-        i = binsearch(dates, self.cycleTime)
-        while i >= 0 and dates[i] >= self.cycleTime:
-            i -= 1
-        i += 1
-        if i != 0:
-            d = warnings.insert({'serial_number': self.serialNum, 'warning_type': 'misplaced', 'warning_time': datetime.datetime.utcnow(), 'start_time': dates[0], 'end_time': dates[i - 1], 'prev_time': self.cycleTime})
-            d.addErrback(print_mongo_error, 'warning')
-            print 'WARNING: misplaced record(s) could not be corrected due to CSV file boundary (CSV file contains records from {0} to {1}, but would normally start at {2})'.format(dates[0], dates[i-1], self.cycleTime)
-            num_records = i
-        # Check for a gap at the beginning of the CSV
-        if dates[i] > self.cycleTime:
-            d = warnings.insert({'serial_number': self.serialNum, 'warning_type': 'missing', 'warning_time': datetime.datetime.utcnow(), 'start_time': self.cycleTime, 'end_time': dates[i] - datetime.timedelta(0, 1)})
-            d.addErrback(print_mongo_error, 'warning')
-            print 'WARNING: missing record(s) (no data from {0} to {1})'.format(self.cycleTime, dates[i] - datetime.timedelta(0, 1))
-            num_records += 1
-        # Check for a gap at the end of the CSV
-        lastTime = nextCycleTime - datetime.timedelta(0, 1)
-        if dates[-1] < lastTime:
-            d = warnings.insert({'serial_number': self.serialNum, 'warning_type': 'missing', 'warning_time': datetime.datetime.utcnow(), 'start_time': dates[-1] + datetime.timedelta(0, 1), 'end_time': lastTime})
-            d.addErrback(print_mongo_error, 'warning')
-            print 'WARNING: missing record(s) (no data from {0} to {1})'.format(dates[-1] + datetime.timedelta(0, 1), lastTime)
-            num_records += 1
-        j = 1
-        while j < len(dates):
-            if j == i:
-                j += 1
-                continue # don't check for gap between last misplaced record and first good record
-            num_records += self._check_sorted_gaps(dates[j-1], dates[j])
-            j += 1
+        for kind, start, end, count in find_irregularities(epochs, datetime_to_epoch(cycleTime), datetime_to_epoch(nextCycleTime)):
+            start_time = epoch_to_datetime(start)
+            end_time = epoch_to_datetime(end)
+            if kind == 'misplaced':
+                warning_writes.insert({'serial_number': self.serialNum, 'warning_type': 'misplaced', 'warning_time': datetime.datetime.utcnow(), 'start_time': start_time, 'end_time': end_time, 'prev_time': cycleTime})
+                print 'WARNING: misplaced record(s) could not be corrected due to CSV file boundary (CSV file contains records from {0} to {1}, but would normally start at {2})'.format(start_time, end_time, cycleTime)
+                num_records += count
+            elif kind == 'duplicate':
+                warning_writes.insert({'serial_number': self.serialNum, 'warning_type': 'duplicate', 'warning_time': datetime.datetime.utcnow(), 'start_time': start_time})
+                print 'WARNING: duplicate record for {0}'.format(start_time)
+                num_records += 1
+            else:
+                warning_writes.insert({'serial_number': self.serialNum, 'warning_type': 'missing', 'warning_time': datetime.datetime.utcnow(), 'start_time': start_time, 'end_time': end_time})
+                print 'WARNING: missing record(s) (no data from {0} to {1})'.format(start_time, end_time)
+                num_records += 1
         return num_records
             
-    def _check_sorted_gaps(self, date1, date2):
-        """ Checks if date1 and date2 are sequential, assuming date1 <= date2.
-        If not, prints an error message and updates Mongo as appropriate.
-        Returns 1 if the dates are not sequential and 0 if they are. """
-        num_errors = 0
-        delta = int((date2 - date1).total_seconds() + 0.5) # round difference to nearest second
-        if delta == 0:
-            d = warnings.insert({'serial_number': self.serialNum, 'warning_type': 'duplicate', 'warning_time': datetime.datetime.utcnow(), 'start_time': date2})
-            d.addErrback(print_mongo_error, 'warning')
-            print 'WARNING: duplicate record for {0}'.format(date2)
-            return 1
-        elif delta != 1:
-            d = warnings.insert({'serial_number': self.serialNum, 'warning_type': 'missing', 'warning_time': datetime.datetime.utcnow(), 'start_time': date1 + datetime.timedelta(0, 1), 'end_time': date2 - datetime.timedelta(0, 1)})
-            d.addErrback(print_mongo_error, 'warning')
-            print 'WARNING: missing record(s) (no data from {0} to {1})'.format(date1 + datetime.timedelta(0, 1), date2 - datetime.timedelta(0, 1))
-            return 1
-        return 0
-            
+def write_failed(err):
+    """ Reports that a file could not be written. ERR is either the exception
+    being handled or a Failure. """
+    if isinstance(err, failure.Failure):
+        exception = err.value
+    else:
+        exception = err
+    if isinstance(exception, KeyboardInterrupt):
+        return False
+    print 'WARNING: write could not be completed due to exception'
+    print 'Details: {0}'.format(exception)
+    print 'Traceback:'
+    if isinstance(exception, WorkerException):
+        print str(exception).rstrip() # The traceback from the worker process
+    elif isinstance(err, failure.Failure):
+        err.printTraceback(sys.stderr)
+    else:
+        traceback.print_exc()
+    return False
+
 def print_mongo_error(err, task):
     print 'WARNING: could not update Mongo Database with recent {0}'.format(task)
     print 'Details:', err
@@ -396,16 +584,163 @@ def latest_time_error(err, serialnumber, filepath):
     print 'Receipt of file', filepath, 'is not recorded'
     print 'Details:', err
 
+class WriteBatcher(object):
+    """ Collects inserts into a Mongo collection, and updates of documents in it
+    by id, and sends them together: all inserts in one message, and one update
+    for each distinct update document. A batch is sent once it holds BATCHSIZE
+    writes, or BATCHTIME seconds after its first write. TASK describes the
+    writes in error messages, and NAME is the name of the collection in metrics. """
+    def __init__(self, collection, task, name):
+        self.collection = collection
+        self.task = task
+        self.name = name
+        self.inserts = []
+        self.updates = [] # pairs of an update document and the ids it applies to
+        self.size = 0
+        self.call = None
+        
+    def insert(self, document):
+        self.inserts.append(document)
+        self._added()
+        
+    def update(self, _id, document):
+        for update, ids in self.updates:
+            if update == document:
+                ids.append(_id)
+                break
+        else:
+            self.updates.append((document, [_id]))
+        self._added()
+        
+    def _added(self):
+        self.size += 1
+        if self.size >= BATCHSIZE:
+            self.flush()
+        elif self.call is None:
+            self.call = reactor.callLater(BATCHTIME, self.flush)
+            
+    def flush(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.inserts:
+            d = mongo_seconds.time_deferred(self.collection.insert(self.inserts), self.name, 'insert')
+            d.addErrback(print_mongo_error, '{0} ({1} documents)'.format(self.task, len(self.inserts)))
+        for document, ids in self.updates:
+            d = mongo_seconds.time_deferred(self.collection.update({'_id': {'$in': ids}}, document, multi=True), self.name, 'update')
+            d.addErrback(print_mongo_error, '{0} ({1} documents)'.format(self.task, len(ids)))
+        self.inserts = []
+        self.updates = []
+        self.size = 0
+
+class FlowControl(object):
+    """ Keeps count of the files received that have not yet been stored
+    (with --rawstore) and added to Mongo, and of the bytes in them, for each
+    connection and in total. Reading from a connection is paused while it, or
+    all connections together, are at the limits, and resumed once inserts
+    complete, so that
+    senders are slowed down instead of the receiver running out of memory.
+    A limit of 0 means no limit. """
+    def __init__(self, maxfiles, maxbytes, maxtotalfiles, maxtotalbytes):
+        self.maxfiles = maxfiles
+        self.maxbytes = maxbytes
+        self.maxtotalfiles = maxtotalfiles
+        self.maxtotalbytes = maxtotalbytes
+        self.files = 0
+        self.bytes = 0
+        self.paused = set() # The protocols whose transports are paused
+        
+    def _full(self, protocol):
+        limits = ((protocol.inflight, self.maxfiles), (protocol.inflightbytes, self.maxbytes), (self.files, self.maxtotalfiles), (self.bytes, self.maxtotalbytes))
+        return any(limit > 0 and count >= limit for count, limit in limits)
+        
+    def started(self, protocol, length):
+        protocol.inflight += 1
+        protocol.inflightbytes += length
+        self.files += 1
+        self.bytes += length
+        if protocol not in self.paused and not protocol.lost and self._full(protocol):
+            print 'Pausing connection {0}: {1} file(s) ({2} bytes) on it and {3} file(s) ({4} bytes) in total are waiting for the database'.format(protocol.transport.getPeer(), protocol.inflight, protocol.inflightbytes, self.files, self.bytes)
+            protocol.transport.pauseProducing()
+            self.paused.add(protocol)
+            
+    def finished(self, protocol, length):
+        protocol.inflight -= 1
+        protocol.inflightbytes -= length
+        self.files -= 1
+        self.bytes -= length
+        for paused in list(self.paused):
+            if not self._full(paused):
+                print 'Resuming connection', paused.transport.getPeer()
+                self.paused.discard(paused)
+                paused.transport.resumeProducing()
+                
+    def forget(self, protocol):
+        self.paused.discard(protocol)
+
 class ResolverFactory(Factory):
     def buildProtocol(self, addr):
         return TCPResolver()
 
-def setup(mconn):
-     global received_files, latest_time, warnings, warnings_summary
+def compress_csv(contents):
+    """ Returns a Deferred that fires with CONTENTS, CSV data, compressed
+    by the compressor pool, or with CONTENTS if there is no pool. """
+    if compressors is None:
+        return defer.succeed(contents)
+    start = time.time()
+    def compressed(result):
+        compress_input_bytes.inc(len(contents))
+        compress_output_bytes.inc(len(result))
+        compress_seconds.since(start)
+        return result
+    return compressors.compress(contents).addCallback(compressed)
+
+def compress_files(files):
+    """ Returns a Deferred that fires with FILES, as returned by
+    encode_window, with the CSV file compressed and named CSV_EXTENSION. """
+    ds = []
+    for extension, contents in files:
+        if extension == '.csv':
+            ds.append(compress_csv(contents).addCallback(lambda compressed: (CSV_EXTENSION, compressed)))
+        else:
+            ds.append(defer.succeed((extension, contents)))
+    return defer.gatherResults(ds, consumeErrors=True)
+
+def finish_writes():
+    """ Waits for the files queued to be written, then sends the Mongo writes
+    still held back and stops the worker processes. """
+    d = store_queue.drain()
+    d.addCallback(lambda ignored: write_queue.drain())
+    d.addCallback(lambda ignored: warning_writes.flush())
+    d.addCallback(lambda ignored: publish_writes.flush())
+    d.addCallback(lambda ignored: workers.close())
+    if compressors is not None:
+        d.addCallback(lambda ignored: compressors.close())
+    return d
+
+def prepare(mconn):
+     """ Sets up the Mongo collections of MCONN, a Mongo connection, and the
+     write batchers and worker pools used to process files. """
+     global received_files, latest_time, warnings, warnings_summary, rollups, warning_writes, publish_writes, workers, write_queue, store_queue, compressors
      received_files = mconn.upmu_database.received_files
      latest_time = mconn.upmu_database.latest_time
      warnings = mconn.upmu_database.warnings
      warnings_summary = mconn.upmu_database.warnings_summary
+     rollups = mconn.upmu_database.rollups
+     if ROLLUPS in ('mongo', 'both'):
+         d = rollups.create_index(txmongo.filter.sort(txmongo.filter.ASCENDING('serial_number') + txmongo.filter.ASCENDING('time')))
+         d.addErrback(print_mongo_error, 'rollups index')
+     warning_writes = WriteBatcher(warnings, 'warning', 'warnings')
+     publish_writes = WriteBatcher(received_files, 'write', 'received_files')
+     workers = WorkerPool(NUM_WORKERS)
+     write_queue = SerialQueue()
+     store_queue = SerialQueue()
+     if GZIPLEVEL > 0:
+         compressors = CompressorPool(NUM_COMPRESSORS, GZIPLEVEL)
+     reactor.addSystemEventTrigger('before', 'shutdown', finish_writes)
+
+def setup(mconn):
+     prepare(mconn)
      try:
          with open('serial_aliases.ini', 'r') as f:
              for line in f:
@@ -413,16 +748,77 @@ def setup(mconn):
                  aliases[pair[0]] = pair[1]
      except:
          print 'WARNING: Could not read serial_aliases.ini'
-     endpoint = TCP4ServerEndpoint(reactor, ADDRESSP)
-     endpoint.listen(ResolverFactory())
+     if journal is not None and args.child is None:
+         print 'Journal holds unfinished CSV files for {0} serial number(s)'.format(len(journal.recover()))
+     listen()
+     if METRICSPORT is not None:
+         ReactorLag(reactor_lag_seconds).start()
+         reactor.listenTCP(METRICSPORT, Site(MetricsResource(registry)), interface='127.0.0.1')
+
+def listen():
+    if NUM_PROCESSES > 1:
+        # Each process has its own socket on the port, and the kernel spreads new connections among them
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', ADDRESSP))
+        sock.listen(50)
+        sock.setblocking(False)
+        reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, ResolverFactory())
+        sock.close()
+    else:
+        endpoint = TCP4ServerEndpoint(reactor, ADDRESSP)
+        endpoint.listen(ResolverFactory())
 
 def termerror(e):
     print "terminal error", e
     lg.error("TERMINAL ERROR: \n%s",e)
     return defer.FAILURE
          
-d = txmongo.MongoConnection()
-d.addCallbacks(setup, termerror)
-d.addErrback(termerror)
+def serve():
+    d = txmongo.MongoConnection()
+    d.addCallbacks(setup, termerror)
+    d.addErrback(termerror)
+    reactor.run()
+
+def supervise():
+    """ Runs NUM_PROCESSES receiver processes, restarting any that exits
+    until the supervisor is told to stop. """
+    if journal is not None:
+        print 'Journal holds unfinished CSV files for {0} serial number(s)'.format(len(journal.recover()))
+    children = {} # Maps process ids to the indices of the receiver processes
+    stopping = []
+    def spawn(index):
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv[1:] + ['--child', str(index)])
+        children[child.pid] = index
+        print 'Started receiver process {0} (pid {1})'.format(index, child.pid)
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in xrange(NUM_PROCESSES):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as ose:
+            if ose.errno == errno.EINTR:
+                continue
+            raise
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print 'WARNING: receiver process {0} (pid {1}) exited with status {2}; restarting it'.format(index, pid, status)
+            time.sleep(1)
+            spawn(index)
 
-reactor.run()
+if __name__ == '__main__':
+    configure()
+    if NUM_PROCESSES > 1 and args.child is None:
+        supervise()
+    else:
+        serve()
@@ -0,0 +1,95 @@
+# Computes per-second and per-minute statistics (minimum, mean, maximum and
+# RMS) of the angle and magnitude channels of a window, and the range of its
+# lockstates, so that overviews need not read every sample. They are written
+# next to the window's output files in the columnar format of columnar.py,
+# and can also be kept in Mongo.
+import numpy as np
+
+from columnar import encode_columnar
+from parser import decode_sync_outputs, times_to_epoch
+from utils import CHANNELS
+
+INTERVALS = ((1, '.1s.col'), (60, '.1m.col')) # seconds, extension of the file
+STATS = ('min', 'mean', 'max', 'rms')
+FIELDS = tuple(('{0}{1}'.format(channel[:2], end), channel, part) for channel in CHANNELS for end, part in (('Ang', 'angle'), ('Mag', 'mag')))
+
+NAMES = ['time', 'samples', 'lockstate_min', 'lockstate_max']
+NAMES.extend('{0}_{1}'.format(name, stat) for name, channel, part in FIELDS for stat in STATS)
+
+def second_rollups(records):
+    """ Returns the per-second statistics of RECORDS, an array of
+    sync_output.DTYPE with one record per second, as a dict mapping the
+    names in NAMES to arrays. Times are in nanoseconds since the epoch. """
+    sync_data = records['sync_data']
+    samples = sync_data['lockstate'].shape[1]
+    rollups = {'time': 1000000000 * times_to_epoch(sync_data['times']),
+               'samples': np.full(len(records), samples, dtype=np.int64),
+               'lockstate_min': sync_data['lockstate'].min(axis=1),
+               'lockstate_max': sync_data['lockstate'].max(axis=1)}
+    for name, channel, part in FIELDS:
+        values = sync_data[channel][part].astype(np.float64)
+        rollups[name + '_min'] = values.min(axis=1)
+        rollups[name + '_mean'] = values.mean(axis=1)
+        rollups[name + '_max'] = values.max(axis=1)
+        rollups[name + '_rms'] = np.sqrt((values * values).mean(axis=1))
+    return rollups
+
+def combine_rollups(rollups, interval):
+    """ Combines ROLLUPS, as returned by second_rollups and sorted by time,
+    into statistics over intervals of INTERVAL seconds aligned with the
+    epoch. Each interval is timed by its start. """
+    seconds = rollups['time'] // 1000000000
+    starts = np.flatnonzero(np.concatenate(([True], np.diff(seconds // interval) != 0)))
+    samples = rollups['samples']
+    total = np.add.reduceat(samples, starts)
+    combined = {'time': 1000000000 * (seconds[starts] - seconds[starts] % interval),
+                'samples': total,
+                'lockstate_min': np.minimum.reduceat(rollups['lockstate_min'], starts),
+                'lockstate_max': np.maximum.reduceat(rollups['lockstate_max'], starts)}
+    for name, channel, part in FIELDS:
+        combined[name + '_min'] = np.minimum.reduceat(rollups[name + '_min'], starts)
+        combined[name + '_mean'] = np.add.reduceat(rollups[name + '_mean'] * samples, starts) / total
+        combined[name + '_max'] = np.maximum.reduceat(rollups[name + '_max'], starts)
+        combined[name + '_rms'] = np.sqrt(np.add.reduceat(rollups[name + '_rms'] ** 2 * samples, starts) / total)
+    return combined
+
+def rollup_documents(rollups):
+    """ Converts ROLLUPS into a list of dicts, one per interval, with the
+    time in seconds since the epoch and the statistics of each channel in a
+    dict of their own. """
+    values = dict((name, rollups[name].tolist()) for name in NAMES)
+    documents = []
+    for i in xrange(len(values['time'])):
+        document = {'time': values['time'][i] // 1000000000,
+                    'samples': values['samples'][i],
+                    'lockstate': {'min': values['lockstate_min'][i], 'max': values['lockstate_max'][i]}}
+        for name, channel, part in FIELDS:
+            document[name] = dict((stat, values['{0}_{1}'.format(name, stat)][i]) for stat in STATS)
+        documents.append(document)
+    return documents
+
+def encode_rollups(records, cycle_start, num_seconds):
+    """ Computes the statistics of the window of NUM_SECONDS seconds
+    starting at CYCLE_START (in seconds since the epoch) from RECORDS, a
+    string of sync_outputs sorted by time, using the first record of each
+    second in the window as the CSV file does. Returns a list of pairs of a
+    file extension and the contents of the columnar file of statistics over
+    the interval it stands for, and the per-minute statistics as returned by
+    rollup_documents. """
+    records = decode_sync_outputs(records)
+    j = times_to_epoch(records['sync_data']['times']) - cycle_start
+    inwindow = np.flatnonzero((j >= 0) & (j < num_seconds))
+    records = records[inwindow[np.unique(j[inwindow], return_index=True)[1]]]
+    if len(records) == 0:
+        return [], []
+    seconds = second_rollups(records)
+    files = []
+    minutes = None
+    for interval, extension in INTERVALS:
+        rollups = seconds if interval == 1 else combine_rollups(seconds, interval)
+        if interval == 60:
+            minutes = rollup_documents(rollups)
+        columns = [rollups[name] for name in NAMES]
+        empty = [column[:0] for column in columns]
+        files.append((extension, encode_columnar(NAMES, (columns, empty, empty))))
+    return files, minutes
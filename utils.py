@@ -1,25 +1,93 @@
 # Functions used by multiple files
 import calendar
 import datetime
+import numpy as np
+
+from parser import stack_records, times_to_epoch
+
+# The channels of a sync_output_msgq, in the order of the columns of a CSV file
+CHANNELS = tuple('{0}{1}MagAng'.format(start, num) for start in ('L', 'C') for num in xrange(1, 4))
+
+# The first row of every csv file has lables
+firstrow = ['time', 'lockstate']
+firstrow.extend('{0}{1}'.format(channel[:2], end) for channel in CHANNELS for end in ('Ang', 'Mag'))
+firstrow.extend(['satellites', 'hasFix'])
 
 def check_duplicates(sorted_struct_list):
     # Check if the structs have duplicates or missing items, print warnings if so
-    dates = tuple(datetime.datetime(*s.sync_data.times) for s in sorted_struct_list)
-    i = 1
-    while i < len(dates):
-        date1 = dates[i-1]
-        date2 = dates[i]
-        delta = int((date2 - date1).total_seconds() + 0.5) # round difference to nearest second
-        if delta == 0:
+    epochs = np.array([s.epoch for s in sorted_struct_list], dtype=np.int64)
+    for i in sequence_breaks(epochs).tolist():
+        date1 = epoch_to_datetime(epochs[i-1])
+        date2 = epoch_to_datetime(epochs[i])
+        if date1 == date2:
             print 'WARNING: duplicate record for {0}'.format(str(date2))
-        elif delta != 1:
+        else:
             print 'WARNING: missing record(s) (skips from {0} to {1})'.format(str(date1), str(date2))
-        i += 1
-        
+            
+def sequence_breaks(epochs):
+    """ Returns the indices i at which EPOCHS, an array of seconds since the
+    epoch, does not advance by exactly one second from EPOCHS[i - 1]. """
+    return np.flatnonzero(np.diff(epochs) != 1) + 1
+    
+def find_irregularities(epochs, window_start, window_end):
+    """ Finds the irregularities in EPOCHS, a sorted array of the times (in
+    seconds since the epoch) of the records for the window from WINDOW_START
+    up to but not including WINDOW_END. Returns a list of intervals
+    (kind, start, end, count), with START and END inclusive, in this order:
+    records before the window ('misplaced', COUNT is the number of records),
+    seconds missing at the start and at the end of the window ('missing',
+    COUNT is the number of seconds), then duplicates ('duplicate', one per
+    extra record, COUNT is 1) and gaps between records in the order in which
+    they occur. """
+    intervals = []
+    i = int(np.searchsorted(epochs, window_start))
+    if i != 0:
+        intervals.append(('misplaced', int(epochs[0]), int(epochs[i - 1]), i))
+    if epochs[i] > window_start:
+        intervals.append(('missing', window_start, int(epochs[i]) - 1, int(epochs[i]) - window_start))
+    if epochs[-1] < window_end - 1:
+        intervals.append(('missing', int(epochs[-1]) + 1, window_end - 1, window_end - 1 - int(epochs[-1])))
+    breaks = sequence_breaks(epochs)
+    breaks = breaks[breaks != i] # don't check for gap between last misplaced record and first good record
+    for before, after in zip(epochs[breaks - 1].tolist(), epochs[breaks].tolist()):
+        if before == after:
+            intervals.append(('duplicate', after, after, 1))
+        else:
+            intervals.append(('missing', before + 1, after - 1, after - before - 1))
+    return intervals
+    
+def window_filename(dirtowrite, filepath, depth, serial, cycle_time, next_cycle_time):
+    """ Returns the name, without an extension, of the output files of SERIAL
+    for the window from the datetime CYCLE_TIME up to NEXT_CYCLE_TIME. They go
+    in DIRTOWRITE, under the last DEPTH directories of FILEPATH, the path of
+    the first file received in the window. """
+    subdirs = filepath.rsplit('/', depth + 1)
+    if subdirs[-1].endswith('.dat'):
+        subdirs[-1] = subdirs[-1][:-4]
+    if len(subdirs) <= depth + 1:
+        print 'WARNING: filepath {0} has insufficient depth'.format(filepath)
+    dirtowrite += '/'.join(subdirs[1:-1])
+    return '{0}/{1}__{2}__{3}'.format(dirtowrite, serial, cycle_time, next_cycle_time - datetime.timedelta(0, 1))
+    
+def datetime_to_epoch(date):
+    """ Converts the time as given as a datetime object into seconds since
+    the epoch. """
+    return calendar.timegm(date.utctimetuple())
+    
+def window_start(epoch, num_seconds, basetime):
+    """ Returns the start, in seconds since the epoch, of the window of
+    NUM_SECONDS seconds that EPOCH (in seconds since the epoch) falls in,
+    counting windows from BASETIME, a datetime. """
+    return epoch - (epoch - datetime_to_epoch(basetime)) % num_seconds
+    
+def epoch_to_datetime(seconds):
+    """ Converts a number of seconds since the epoch into a datetime object. """
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(0, int(seconds))
+    
 def time_to_nanos(date):
     """ Converts the time as given as a datetime object into nanoseconds since
 the epoch. """
-    return 1000000000 * calendar.timegm(date.utctimetuple())
+    return 1000000000 * datetime_to_epoch(date)
     
 def time_to_str(lst):
     """ Converts the time as given in a time[] array into a string representation. """
@@ -27,27 +95,94 @@ def time_to_str(lst):
     time_rep = time_rep.replace(' ', '_')
     return time_rep
     
+def records_to_columns(records):
+    """ Converts RECORDS, an array of sync_output.DTYPE, into the columns of
+    the corresponding CSV rows (120 per record). Returns a list of arrays, one
+    per column, in the same order as the columns of a CSV file. """
+    sync_data = records['sync_data']
+    basetime = 1000000000 * times_to_epoch(sync_data['times'])
+    # it seems sampleRate is the number of milliseconds between samples
+    timedelta = 1000000 * sync_data['sampleRate'].astype(np.float64) # nanoseconds between samples
+    offsets = (np.arange(120) * timedelta[:, np.newaxis] + 0.5).astype(np.int64)
+    columns = [(basetime[:, np.newaxis] + offsets).ravel(), sync_data['lockstate'].ravel()]
+    for channel in CHANNELS:
+        columns.append(sync_data[channel]['angle'].ravel())
+        columns.append(sync_data[channel]['mag'].ravel())
+    for field in ('satellites', 'hasFix'):
+        columns.append(np.repeat(records['gps_stats'][field], 120))
+    return columns
+    
+def columns_to_rows(columns):
+    """ Converts COLUMNS, a list of equally long arrays, into a list of rows
+    that can be passed to a csv.writer. """
+    return zip(*[column.tolist() for column in columns])
+
+def columns_to_csv(columns, present=None):
+    """ Formats COLUMNS, a list of equally long arrays, as the CSV rows that a
+    csv.writer would write for the rows returned by columns_to_rows, all at
+    once. If PRESENT, an array with one entry per 120 rows, is given, the rows
+    of the seconds for which it is False are written empty. Floats are
+    written as their repr, which numpy's conversion to strings matches. """
+    cells = [column.astype(np.float64 if column.dtype.kind == 'f' else column.dtype).astype('S') for column in columns]
+    widths = [cell.itemsize for cell in cells]
+    out = np.zeros((len(columns[0]), sum(widths) + len(cells) + 1), dtype=np.uint8)
+    start = 0
+    for cell, width in zip(cells, widths):
+        out[:, start:start + width] = cell.view(np.uint8).reshape(-1, width)
+        out[:, start + width] = ord(',')
+        start += width + 1
+    if present is not None:
+        out[np.repeat(~present, 120), :start] = 0
+    out[:, start - 1:] = np.frombuffer('\r\n', dtype=np.uint8) # Replaces the last comma
+    out = out.ravel()
+    return out[out != 0].tostring() # Strings are padded with zeros
+
 def lst_to_rows(parsed):
-    rows = []
-    for s in parsed:
-        basetime = time_to_nanos(datetime.datetime(*s.sync_data.times))
-        # it seems s.sync_data.sampleRate is the number of milliseconds between samples
-        timedelta = 1000000 * s.sync_data.sampleRate # nanoseconds between samples
-        i = 0
-        while i < 120:
-            row = []
-            row.append(basetime + int((i * timedelta) + 0.5))
-            row.append(s.sync_data.lockstate[i])
-            for start in ('L', 'C'):
-                for num in xrange(1, 4):
-                    attribute = getattr(s.sync_data, '{0}{1}MagAng'.format(start, num))
-                    row.append(attribute[i].angle)
-                    row.append(attribute[i].mag)
-            row.append(s.gps_stats.satellites)
-            row.append(s.gps_stats.hasFix)
-            i += 1
-            rows.append(row)
-    return rows
+    return columns_to_rows(records_to_columns(stack_records(parsed)))
+    
+def window_to_columns(records, cycle_start, num_seconds):
+    """ Converts RECORDS, an array of sync_output.DTYPE, into the columns of
+    the window of NUM_SECONDS seconds starting at CYCLE_START (in seconds
+    since the epoch). Returns the columns of the records that belong before
+    the window, the columns of the window itself (120 * NUM_SECONDS rows,
+    placed by their offset from CYCLE_START), an array that is True for each
+    second of the window that has a record, and the columns of the records
+    whose second already appears earlier in RECORDS. """
+    j = times_to_epoch(records['sync_data']['times']) - cycle_start
+    early = j < 0
+    inwindow = np.flatnonzero(~early)
+    first = np.zeros(len(records), dtype=bool)
+    first[inwindow[np.unique(j[inwindow], return_index=True)[1]]] = True
+    duplicate = ~(early | first)
+    columns = records_to_columns(records)
+    indices = (120 * j[first][:, np.newaxis] + np.arange(120)).ravel()
+    window = []
+    for column in columns:
+        filled = np.zeros(120 * num_seconds, dtype=column.dtype)
+        filled[indices] = column[np.repeat(first, 120)]
+        window.append(filled)
+    present = np.zeros(num_seconds, dtype=bool)
+    present[j[first]] = True
+    earlyColumns = [column[np.repeat(early, 120)] for column in columns]
+    duplicateColumns = [column[np.repeat(duplicate, 120)] for column in columns]
+    return earlyColumns, window, present, duplicateColumns
+    
+def window_to_rows(records, cycle_start, num_seconds):
+    """ Converts RECORDS, an array of sync_output.DTYPE, into the rows of the
+    CSV file for the window of NUM_SECONDS seconds starting at CYCLE_START
+    (in seconds since the epoch). Returns three lists of rows: the rows of
+    records that belong before the window, the 120 * NUM_SECONDS rows of the
+    window itself (empty for seconds with no record), and the rows of records
+    whose second already appears earlier in RECORDS. """
+    return window_columns_to_rows(*window_to_columns(records, cycle_start, num_seconds))
+    
+def window_columns_to_rows(earlyColumns, window, present, duplicateColumns):
+    """ Converts the output of window_to_columns into the output of
+    window_to_rows. """
+    rows = columns_to_rows(window)
+    for second in np.flatnonzero(~present).tolist():
+        rows[120 * second:120 * (second + 1)] = [()] * 120
+    return columns_to_rows(earlyColumns), rows, columns_to_rows(duplicateColumns)
     
 def binsearch(sorted_lst, item):
     """ Returns the index of ITEM in SORTED_LST if it is in the list; otherwise it returns
@@ -0,0 +1,119 @@
+# A compact buffer for the records of the CSV window of one uPMU
+import numpy as np
+
+from parser import sync_output, times_to_epoch
+
+class WindowBuffer(object):
+    """ Holds the records of the window of NUM_SECONDS seconds starting at
+    START (in seconds since the epoch, or None if not yet known) as they
+    arrive. Each second of the window has a slot in a preallocated array of
+    sync_output.DTYPE; records for a second whose slot is already filled,
+    records from before or after the window, and records received before
+    START is known are kept in a side table in the order in which they
+    arrived. The ids of the Mongo documents of the files are kept with the
+    time of the last record of each file, so that a file is published with
+    the window that holds its last record. """
+    def __init__(self, num_seconds, start=None):
+        self.num_seconds = num_seconds
+        self.start = start
+        self.slots = np.zeros(num_seconds, dtype=sync_output.DTYPE)
+        self.present = np.zeros(num_seconds, dtype=bool)
+        self.filled = 0 # The number of slots in use
+        self.streamed = 0 # The number of seconds at the start of the window returned by stream
+        self.extra = [] # Arrays of the records not in a slot, in the order in which they arrived
+        self.extraepochs = [] # The times of those records
+        self.mongoids = [] # Pairs of the time of the last record of a file and the id of its Mongo document
+        self.firstfilepath = None # The path of the first file of the window, after which its output file is named
+
+    def __len__(self):
+        return self.filled + sum(len(records) for records in self.extra)
+
+    def add(self, records, mongoid=None):
+        """ Adds RECORDS, an array of sync_output.DTYPE received in one file.
+        MONGOID is the id of the file's Mongo document, if any. """
+        if len(records) == 0:
+            return
+        epochs = times_to_epoch(records['sync_data']['times'])
+        if mongoid is not None:
+            self.mongoids.append((int(epochs[-1]), mongoid))
+        self._place(records, epochs)
+
+    def _place(self, records, epochs):
+        rest = np.ones(len(records), dtype=bool)
+        if self.start is not None:
+            j = epochs - self.start
+            inwindow = np.flatnonzero((j >= 0) & (j < self.num_seconds))
+            first = inwindow[np.unique(j[inwindow], return_index=True)[1]] # The first record for each second
+            first = first[~self.present[j[first]]]
+            self.slots[j[first]] = records[first]
+            self.present[j[first]] = True
+            self.filled += len(first)
+            rest[first] = False
+        if rest.any():
+            self.extra.append(records[rest])
+            self.extraepochs.append(epochs[rest])
+
+    def _extra(self):
+        if not self.extra:
+            return np.zeros(0, dtype=sync_output.DTYPE), np.zeros(0, dtype=np.int64)
+        return np.concatenate(self.extra), np.concatenate(self.extraepochs)
+
+    def records(self):
+        """ Returns every record held, as an array of sync_output.DTYPE, and
+        the pairs of time and Mongo id of the files. Restoring them into an
+        empty WindowBuffer with the same START fills the same slots. """
+        extra, extraepochs = self._extra()
+        return np.concatenate((self.slots[self.present], extra)), list(self.mongoids)
+
+    def restore(self, records, mongoids):
+        """ Adds RECORDS and MONGOIDS, as returned by records. """
+        self._place(records, times_to_epoch(records['sync_data']['times']))
+        self.mongoids.extend(mongoids)
+
+    def move(self, start):
+        """ Moves the window to START, placing the records held again. """
+        records, mongoids = self.records()
+        self._clear()
+        self.start = start
+        self.restore(records, mongoids)
+
+    def stream(self):
+        """ Returns the records in the slots from the first second not yet
+        streamed up to the first empty slot, and counts them as streamed.
+        Records that arrive later for those seconds are duplicates. """
+        missing = np.flatnonzero(~self.present[self.streamed:])
+        end = self.streamed + int(missing[0]) if len(missing) else self.num_seconds
+        records = self.slots[self.streamed:end].copy()
+        self.streamed = end
+        return records
+
+    def _clear(self):
+        self.present[:] = False
+        self.filled = 0
+        self.streamed = 0
+        self.extra = []
+        self.extraepochs = []
+        self.mongoids = []
+
+    def take(self):
+        """ Removes the records of the window, including those from before it,
+        and moves on to the next window. Returns them as an array of
+        sync_output.DTYPE sorted by time, with the first record received for
+        each second before any duplicates of it, the array of their times,
+        and the ids of the Mongo documents of the files whose last record is
+        among them. """
+        end = self.start + self.num_seconds
+        extra, extraepochs = self._extra()
+        before = extraepochs < end
+        seconds = np.flatnonzero(self.present)
+        records = np.concatenate((self.slots[seconds], extra[before]))
+        epochs = np.concatenate((self.start + seconds, extraepochs[before]))
+        order = np.argsort(epochs, kind='mergesort')
+        mongoids = [mongoid for epoch, mongoid in self.mongoids if epoch < end]
+        remaining = [(epoch, mongoid) for epoch, mongoid in self.mongoids if epoch >= end]
+        self._clear()
+        self.start = end
+        self.mongoids = remaining
+        if not before.all():
+            self._place(extra[~before], extraepochs[~before])
+        return records[order], epochs[order], mongoids
@@ -0,0 +1,231 @@
+# Runs the CPU-bound encoding of output files in a pool of processes and the
+# writing of those files in a pool of threads, so that the reactor thread
+# is left free to read from and acknowledge the uPMUs
+import cStringIO
+import csv
+import errno
+import multiprocessing
+import numpy as np
+import os
+import signal
+import traceback
+import zlib
+
+from archiveindex import index_window
+from columnar import encode_columnar, EXTENSION as COLUMNAR_EXTENSION
+from parser import decode_sync_outputs
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+from utils import columns_to_csv, firstrow, records_to_columns, window_to_columns
+
+class WorkerException(RuntimeError):
+    pass
+
+def encode_window(records, cycle_start, num_seconds, outputformat, streamed=0):
+    """ Encodes the window of NUM_SECONDS seconds starting at CYCLE_START (in
+    seconds since the epoch) from RECORDS, a string of sync_outputs, in
+    OUTPUTFORMAT ('csv', 'columnar' or 'both'). Returns a list of pairs of a
+    file extension and the contents of the file with that extension. If
+    STREAMED is not 0, the header and the rows of the first STREAMED seconds
+    of the CSV file have already been written by encode_rows, and are left
+    out of it. """
+    earlyColumns, window, present, duplicateColumns = window_to_columns(decode_sync_outputs(records), cycle_start, num_seconds)
+    files = []
+    if outputformat in ('csv', 'both'):
+        f = cStringIO.StringIO()
+        writer = csv.writer(f)
+        if not streamed:
+            writer.writerow(firstrow)
+        f.write(columns_to_csv([column[120 * streamed:] for column in window], present[streamed:]))
+        writer.writerow([])
+        if len(duplicateColumns[0]):
+            writer.writerow(['Duplicate records (entries for same times exist in this CSV file):'])
+            f.write(columns_to_csv(duplicateColumns))
+            writer.writerow([])
+        if len(earlyColumns[0]):
+            writer.writerow(['Misplaced records (should be in earlier CSV file):'])
+            f.write(columns_to_csv(earlyColumns))
+        files.append(('.csv', f.getvalue()))
+    if outputformat in ('columnar', 'both'):
+        normalColumns = [column[np.repeat(present, 120)] for column in window]
+        files.append((COLUMNAR_EXTENSION, encode_columnar(firstrow, (normalColumns, duplicateColumns, earlyColumns))))
+    return files
+
+def encode_rows(records, header):
+    """ Encodes the rows of the CSV file for RECORDS, a string of
+    sync_outputs for consecutive seconds, preceded by the header if HEADER
+    is True. """
+    f = cStringIO.StringIO()
+    writer = csv.writer(f)
+    if header:
+        writer.writerow(firstrow)
+    f.write(columns_to_csv(records_to_columns(decode_sync_outputs(records))))
+    return f.getvalue()
+
+def _makedirs(filename):
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError as ose:
+        if ose.errno != errno.EEXIST:
+            raise
+
+def write_partial(filename, extension, contents, first):
+    """ Adds CONTENTS to the unfinished file that write_files will complete
+    as FILENAME followed by EXTENSION, creating it (and the directory, if
+    necessary) if FIRST is True. """
+    _makedirs(filename)
+    with open(filename + extension + '.tmp', 'wb' if first else 'ab') as f:
+        f.write(contents)
+
+def write_files(filename, files, partial=()):
+    """ Writes FILES, as returned by encode_window, to FILENAME followed by
+    each extension, creating the directory if necessary. Each file is written
+    under a temporary name and renamed into place once complete, so a file
+    that exists is whole. The contents for the extensions in PARTIAL are
+    added to what write_partial has written. Returns the names of the files
+    written. """
+    _makedirs(filename)
+    written = []
+    for extension, contents in files:
+        with open(filename + extension + '.tmp', 'ab' if extension in partial else 'wb') as f:
+            f.write(contents)
+        os.rename(filename + extension + '.tmp', filename + extension)
+        written.append(filename + extension)
+    return written
+
+def write_indexed(filename, files, partial, serialdir, cycle_start, num_seconds):
+    """ Writes FILES as write_files does, then adds the CSV file among them
+    to the index of SERIALDIR (see archiveindex.py) for the window of
+    NUM_SECONDS seconds starting at CYCLE_START. A file that cannot be indexed
+    is still written. Returns the names of the files written. """
+    written = write_files(filename, files, partial)
+    for extension, contents in files:
+        if extension in ('.csv', '.csv.gz'):
+            if extension in partial or extension != '.csv':
+                contents = None # Read the whole uncompressed file back
+            try:
+                index_window(serialdir, filename + extension, cycle_start, num_seconds, contents)
+            except BaseException as be:
+                print 'WARNING: could not index {0}: {1}'.format(filename + extension, be)
+    return written
+
+def gzip_member(contents, level):
+    """ Returns CONTENTS compressed at LEVEL as a gzip member. Members
+    written one after another form a gzip file of their contents joined. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(contents) + compressor.flush()
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The receiver shuts the pool down itself
+
+def _call(func, args):
+    try:
+        return True, func(*args)
+    except BaseException:
+        return False, traceback.format_exc()
+
+class WorkerPool(object):
+    """ Runs functions in PROCESSES worker processes and file writes in the
+    reactor's thread pool, returning Deferreds that fire in the reactor thread
+    with their results. With no processes, everything is run immediately in
+    the calling thread instead. """
+    def __init__(self, processes):
+        self.processes = processes
+        if processes > 0:
+            self._pool = multiprocessing.Pool(processes, _ignore_sigint)
+        else:
+            self._pool = None
+
+    def run(self, func, *args):
+        """ Calls FUNC, which must be a module-level function, with ARGS in a
+        worker process. An exception raised by it fails the Deferred with a
+        WorkerException holding its traceback. """
+        if self._pool is None:
+            return defer.maybeDeferred(func, *args)
+        d = defer.Deferred()
+        self._pool.apply_async(_call, (func, args), callback=lambda result: reactor.callFromThread(self._finished, d, result))
+        return d
+
+    def _finished(self, d, result):
+        ok, value = result
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(WorkerException(value))
+
+    def write(self, func, *args):
+        """ Calls FUNC with ARGS in a thread. """
+        if self._pool is None:
+            return defer.maybeDeferred(func, *args)
+        return threads.deferToThread(func, *args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class CompressorPool(object):
+    """ Compresses with gzip at LEVEL in THREADS threads of its own, which
+    keep compressing while the reactor thread runs since zlib releases the
+    GIL. With no threads, compresses in the calling thread instead. """
+    def __init__(self, threads, level):
+        self.level = level
+        if threads > 0:
+            self._pool = threadpool.ThreadPool(threads, threads, 'compressor')
+            self._pool.start()
+        else:
+            self._pool = None
+
+    def compress(self, contents):
+        """ Returns a Deferred that fires with CONTENTS as a gzip member. """
+        if self._pool is None:
+            return defer.maybeDeferred(gzip_member, contents, self.level)
+        return threads.deferToThreadPool(reactor, self._pool, gzip_member, contents, self.level)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+class SerialQueue(object):
+    """ Runs work queued under the same key one piece at a time, in the order
+    in which it was queued. Work under different keys runs concurrently. """
+    def __init__(self):
+        self._tails = {} # Maps keys to Deferreds that fire when their last piece of work is done
+
+    def __len__(self):
+        """ Returns the number of keys with work queued or running. """
+        return len(self._tails)
+
+    def run(self, key, func, *args):
+        """ Calls FUNC with ARGS once all work previously queued under KEY is
+        done. FUNC may return a Deferred, in which case the work is done when
+        it fires. Returns a Deferred that fires with the result. """
+        done = defer.Deferred()
+        previous = self._tails.get(key)
+        self._tails[key] = done
+        def start(ignored=None):
+            d = defer.maybeDeferred(func, *args)
+            d.addBoth(self._release, key, done)
+            return d
+        if previous is None:
+            return start()
+        result = defer.Deferred()
+        previous.addCallback(lambda ignored: start().chainDeferred(result))
+        return result
+
+    def _release(self, result, key, done):
+        if self._tails.get(key) is done:
+            del self._tails[key]
+        done.callback(None)
+        return result
+
+    def wait(self, key):
+        """ Returns a Deferred that fires once all work queued so far under
+        KEY is done. """
+        return self.run(key, lambda: None)
+
+    def drain(self):
+        """ Returns a Deferred that fires once all work queued so far is done. """
+        return defer.DeferredList(self._tails.values())